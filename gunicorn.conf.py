@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn の設定(Procfile: web: gunicorn main:app -c gunicorn.conf.py)
+Webhook・ダッシュボード・定期実行のリクエストを複数ワーカー×スレッドで並行して受ける。
+
+    WEB_CONCURRENCY       ワーカー(プロセス)数      既定 2
+    WEB_THREADS           ワーカーごとのスレッド数  既定 8
+    WEB_TIMEOUT           1リクエストの上限(秒)     既定 60
+    WEB_GRACEFUL_TIMEOUT  SIGTERM後に待つ秒数       既定 28(Herokuは30秒で強制終了)
+
+処理済みメッセージID・取り込みジョブの状態は、LINEの再送が別ワーカーに届いても
+二重に取り込まないよう、常に WORKER_DB_PATH(既定 /tmp/toyosu-bot-worker.sqlite3)の
+SQLiteでワーカー間で共有する(dynoごと。再起動で消えても困らない)。
+ローカルDB(LOCAL_DB_PATH)は既定では使わない。設定すると予定・ログもワーカー間で
+SQLiteで共有するが、Herokuの /tmp は再起動で消えるうえdynoごとに別なので、
+web dynoが1台のときだけ有効にする:
+    heroku config:set LOCAL_DB_PATH=/tmp/toyosu-bot.sqlite3
+"""
+import os
+import time
+
+bind = "0.0.0.0:" + os.getenv("PORT", "5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "28"))
+keepalive = 5
+accesslog = "-"
+
+os.environ.setdefault("SHUTDOWN_TIMEOUT", str(max(1, graceful_timeout - 3)))
+# 起動ごとのID。Sheetsとの突き合わせを最初のワーカーだけが行うのに使う
+os.environ["BOT_BOOT_ID"] = "%d-%d" % (os.getpid(), time.time())
+
+
+def post_worker_init(worker):
+    """ワーカー起動直後に、認証・ワークシート・予定の読み込みを裏で済ませておき、
+    前回の終了で中断された取り込みをやり直し、内蔵スケジューラを動かす
+    (import時には始めない。ツールやテストからの import でスレッドが立たないように)"""
+    import main
+    if main.WARMUP_ON_BOOT:
+        main.warm_up_async("boot")
+    main.resume_jobs_async()
+    main.start_scheduler()
+
+
+def worker_exit(server, worker):
+    """ワーカー終了時(SIGTERM・再起動)に、取り込み・複製・ログを書き終えてから抜ける"""
+    import main
+    main.shutdown()
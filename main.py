@@ -5,19 +5,33 @@ group Aに投稿される週間予定PDFをClaude APIで解析し、
 毎朝の担当リマインドをgroup Aに自動配信する。
 管理ダッシュボード(/admin)付き。
 """
+import atexit
 import base64
+import collections
+import collections.abc
+import contextlib
+import contextvars
+import hashlib
+import io
 import json
 import os
+import queue
+import random
 import re
+import signal
+import sqlite3
 import sys
 import time
+import unicodedata
+import uuid
 import datetime
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
-from flask import Flask, request, abort, jsonify, render_template
+from flask import Flask, request, abort, jsonify, render_template, g
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, FileMessage, TextSendMessage
 import gspread
 from google.oauth2.service_account import Credentials
@@ -49,46 +63,661 @@ def now_jst():
     return datetime.datetime.now(JST)
 
 
+@contextlib.contextmanager
+def _file_lock(path):
+    """同じファイルを使うプロセス(gunicornのワーカー)の間の排他。fcntlがなければ何もしない"""
+    try:
+        import fcntl
+    except ImportError:   # Windowsなど。1プロセスで動かす前提
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# ── 診療科(テナント) ─────────────────────────────────────
+# 1つのデプロイで複数の診療科を受け持つ。TENANTS_JSON に診療科ごとの
+# グループ・スプレッドシート・使う担当欄・解析プロンプトの追記を並べる:
+#   [{"id": "seikei", "group_a": "C...", "group_b": "C...", "spreadsheet_id": "...",
+#     "fields": ["救急", "AM院内", "PM院内"], "prompt": "この科の表では…",
+#     "targets": ["C...", "U..."]}]
+# targets は毎朝のリマインドの送り先(グループ・個人。省略時は group_a だけ)。
+# 未設定なら従来の GROUP_ID_A / GROUP_ID_B / SPREADSHEET_ID(と DELIVERY_TARGETS)
+# から1件だけ作る。
+# 処理中の診療科は contextvar で持ち、キャッシュ・ワークシート・ローカルDB・
+# ログの退避ファイルは診療科ごとに分ける。
+DEFAULT_TENANT = "default"
+
+
+def _load_tenants():
+    raw = os.getenv("TENANTS_JSON", "")
+    items = json.loads(raw) if raw else [{
+        "id": DEFAULT_TENANT, "group_a": GROUP_ID_A, "group_b": GROUP_ID_B,
+        "spreadsheet_id": SPREADSHEET_ID,
+        "targets": [t.strip() for t in os.getenv("DELIVERY_TARGETS", "").split(",") if t.strip()],
+    }]
+    tenants = collections.OrderedDict()
+    for t in items:
+        tenants[t["id"]] = {
+            "id": t["id"], "name": t.get("name") or t["id"],
+            "group_a": t.get("group_a", ""), "group_b": t.get("group_b", ""),
+            "spreadsheet_id": t["spreadsheet_id"],
+            "fields": [f for f in t.get("fields") or FIELDS if f in FIELDS],
+            "prompt": t.get("prompt", ""),
+            "targets": t.get("targets") or [t.get("group_a", "")],
+        }
+    return tenants
+
+
+TENANTS = _load_tenants()
+_tenant_var = contextvars.ContextVar("tenant", default=None)
+
+
+def current_tenant():
+    return _tenant_var.get() or next(iter(TENANTS.values()))
+
+
+@contextlib.contextmanager
+def use_tenant(tenant):
+    token = _tenant_var.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _tenant_var.reset(token)
+
+
+def tenant_for_group(group_id):
+    """グループIDから診療科を引く(登録外ならNone)"""
+    for t in TENANTS.values():
+        if group_id and group_id in (t["group_a"], t["group_b"]):
+            return t
+    return None
+
+
+def _tenant_path(path):
+    """診療科ごとのファイル名(既定の診療科はそのまま、ほかは foo.<id>.sqlite3 の形)"""
+    tid = current_tenant()["id"]
+    if not path or tid == DEFAULT_TENANT:
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s.%s%s" % (root, tid, ext)
+
+
+class _TenantState(collections.abc.MutableMapping):
+    """診療科ごとに別の中身を持つ状態dict。今の診療科の分を読み書きする"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._by_tenant = {}
+        self._lock = threading.Lock()
+
+    def _current(self):
+        tid = current_tenant()["id"]
+        d = self._by_tenant.get(tid)
+        if d is None:
+            with self._lock:
+                d = self._by_tenant.setdefault(tid, self._factory())
+        return d
+
+    def __getitem__(self, key):
+        return self._current()[key]
+
+    def __setitem__(self, key, value):
+        self._current()[key] = value
+
+    def __delitem__(self, key):
+        del self._current()[key]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+
+# ── 計測(外部サービスの所要時間・エラー・再試行) ───────────────
+# Sheets・LINE・Anthropicへの呼び出しを依存先・操作ごとに数える
+# (所要時間のヒストグラム・エラー数・再試行数)。遅かった朝に、時間が
+# かかったのがSheetsかLINEかAIかを /metrics(Prometheus形式)と
+# 管理画面の p50/p95 で見分けられるようにする。
+# リクエストごとにトレースID(HerokuのX-Request-Idがあればそれ)を contextvar で持ち、
+# 取り込みジョブ・診療科ごとの処理へも引き継ぐ。エラー数は通信・APIの失敗だけで、
+# 応答の検証で打ち切った解析(医師名が不正など)は数えない。
+# 数値はプロセスごとに持つ。ローカルDBを使うときは METRICS_FLUSH 秒ごとに
+# metrics 表へ書き、同じ起動の全ワーカーの分を合算して返す。
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)   # 秒
+METRICS_SAMPLES = 200   # p50/p95用に残す直近の所要時間の数(依存先・操作ごと)
+METRICS_FLUSH   = 10    # 秒
+_metrics = {}   # "依存先|操作" → {"count", "sum", "errors", "retries", "buckets", "recent"}
+_metrics_lock = threading.Lock()
+_metrics_flushed = {"at": 0.0}
+_trace_var = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace():
+    return _trace_var.get()
+
+
+def new_trace(prefix=""):
+    """新しいトレースIDを振る。戻り値のtokenで _trace_var.reset() する"""
+    return _trace_var.set(prefix + uuid.uuid4().hex[:12])
+
+
+def _empty_metric():
+    return {"count": 0, "sum": 0.0, "errors": 0, "retries": 0,
+            "buckets": [0] * len(METRICS_BUCKETS), "recent": []}
+
+
+def _metric(dep, op):
+    key = "%s|%s" % (dep, op)
+    m = _metrics.get(key)
+    if m is None:
+        m = _metrics[key] = dict(_empty_metric(),
+                                 recent=collections.deque(maxlen=METRICS_SAMPLES))
+    return m
+
+
+def record_call(dep, op, seconds, error=None):
+    """外部呼び出し1回の所要時間を記録する(errorがあれば失敗として数える)"""
+    with _metrics_lock:
+        m = _metric(dep, op)
+        m["count"] += 1
+        m["sum"] += seconds
+        m["recent"].append(round(seconds, 3))
+        for i, le in enumerate(METRICS_BUCKETS):
+            if seconds <= le:
+                m["buckets"][i] += 1
+        if error is not None:
+            m["errors"] += 1
+    _flush_metrics()
+
+
+def record_retry(dep, op):
+    with _metrics_lock:
+        _metric(dep, op)["retries"] += 1
+
+
+# 依存先の失敗として数える例外(通信・API側のエラー。TimeoutErrorもOSErrorに含まれる)
+_DEPENDENCY_ERRORS = (OSError, LineBotApiError, gspread.exceptions.GSpreadException)
+
+
+@contextlib.contextmanager
+def observe(dep, op, errors=()):
+    """囲んだ外部呼び出しの所要時間を記録する。
+    通信・APIの例外(_DEPENDENCY_ERRORS と errors)は失敗として数えてそのまま投げる。
+    それ以外(応答の検証で打ち切ったときのValueErrorなど)は依存先の失敗ではないので、
+    記録せずに投げる"""
+    started = time.monotonic()
+    try:
+        yield
+    except _DEPENDENCY_ERRORS + tuple(errors) as e:
+        record_call(dep, op, time.monotonic() - started, e)
+        raise
+    record_call(dep, op, time.monotonic() - started)
+
+
+def _metrics_rows():
+    with _metrics_lock:
+        return {k: dict(m, buckets=list(m["buckets"]), recent=list(m["recent"]))
+                for k, m in _metrics.items()}
+
+
+def _flush_metrics(force=False):
+    """このプロセスの数値をローカルDBへ書く(METRICS_FLUSH秒に1回まで)"""
+    if not LOCAL_DB_PATH:
+        return
+    now = time.monotonic()
+    if not force and now - _metrics_flushed["at"] < METRICS_FLUSH:
+        return
+    _metrics_flushed["at"] = now
+    with use_tenant(None):
+        db = _db()
+    try:
+        db.execute("INSERT OR REPLACE INTO metrics (pid, boot, updated, data) VALUES (?, ?, ?, ?)",
+                   (os.getpid(), BOOT_ID, time.time(), json.dumps(_metrics_rows())))
+        if random.random() < 0.1:
+            db.execute("DELETE FROM metrics WHERE boot != ?", (BOOT_ID,))
+    except sqlite3.Error as e:
+        sys.stderr.write("計測値の記録エラー: %s\n" % e)
+
+
+def metrics_snapshot():
+    """{"依存先|操作": 数値} を返す。ローカルDB使用時は同じ起動の全ワーカーの合計"""
+    merged = _metrics_rows()
+    if not LOCAL_DB_PATH or not BOOT_ID:
+        return merged
+    with use_tenant(None):
+        db = _db()
+    try:
+        rows = db.execute("SELECT data FROM metrics WHERE boot = ? AND pid != ?",
+                          (BOOT_ID, os.getpid())).fetchall()
+    except sqlite3.Error as e:
+        sys.stderr.write("計測値の読み込みエラー: %s\n" % e)
+        return merged
+    for (data,) in rows:
+        for key, m in json.loads(data).items():
+            t = merged.setdefault(key, _empty_metric())
+            for f in ("count", "sum", "errors", "retries"):
+                t[f] += m[f]
+            t["buckets"] = [a + b for a, b in zip(t["buckets"], m["buckets"])]
+            t["recent"] = t["recent"] + m["recent"]
+    return merged
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def dependency_stats():
+    """依存先ごとの呼び出し数・失敗数・再試行数と直近の p50/p95(秒)。操作ごとの内訳付き"""
+    deps = collections.OrderedDict()
+    for key, m in sorted(metrics_snapshot().items()):
+        dep, op = key.split("|", 1)
+        d = deps.setdefault(dep, dict(_empty_metric(), ops={}))
+        for f in ("count", "errors", "retries"):
+            d[f] += m[f]
+        d["recent"] += m["recent"]
+        d["ops"][op] = {"count": m["count"], "errors": m["errors"], "retries": m["retries"],
+                        "p50": _percentile(m["recent"], 0.5), "p95": _percentile(m["recent"], 0.95)}
+    return [{"dep": dep, "count": d["count"], "errors": d["errors"], "retries": d["retries"],
+             "p50": _percentile(d["recent"], 0.5), "p95": _percentile(d["recent"], 0.95),
+             "ops": d["ops"]} for dep, d in deps.items()]
+
+
+def metrics_text():
+    """Prometheusのテキスト形式"""
+    name = "toyosu_bot_dependency"
+    lines = [
+        "# HELP %s_seconds 外部サービス呼び出しの所要時間" % name,
+        "# TYPE %s_seconds histogram" % name,
+    ]
+    snapshot = sorted(metrics_snapshot().items())
+    for key, m in snapshot:
+        labels = 'dep="%s",op="%s"' % tuple(key.split("|", 1))
+        for le, n in zip(METRICS_BUCKETS, m["buckets"]):
+            lines.append('%s_seconds_bucket{%s,le="%g"} %d' % (name, labels, le, n))
+        lines.append('%s_seconds_bucket{%s,le="+Inf"} %d' % (name, labels, m["count"]))
+        lines.append("%s_seconds_sum{%s} %.6f" % (name, labels, m["sum"]))
+        lines.append("%s_seconds_count{%s} %d" % (name, labels, m["count"]))
+    for field, help_text in (("errors", "失敗した呼び出しの数"), ("retries", "再試行の数")):
+        lines.append("# HELP %s_%s_total %s" % (name, field, help_text))
+        lines.append("# TYPE %s_%s_total counter" % (name, field))
+        for key, m in snapshot:
+            lines.append('%s_%s_total{dep="%s",op="%s"} %d'
+                         % ((name, field) + tuple(key.split("|", 1)) + (m[field],)))
+    return "\n".join(lines) + "\n"
+
+
 # ── Google Sheets ───────────────────────────────────────
+# 認証済みクライアント・HTTPセッション・ワークシートをプロセス内で使い回す。
+# 以前は呼び出しのたびに認証→open_by_keyしており、毎朝の配信1回で
+# 認証が4〜6回走っていた。トークンの更新はAuthorizedSessionが自動で行う。
+SHEETS_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+_sheets_lock = threading.Lock()
+_sheets_client = {"client": None}   # 認証済みクライアントは全診療科で共有
+_sheets = _TenantState(lambda: {"spreadsheet": None, "worksheets": {}})
+
+
+def _sheets_session():
+    """接続を再利用するHTTPセッション(トークン期限切れ時は自動更新)"""
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    creds = Credentials.from_service_account_info(
+        json.loads(GOOGLE_CREDS_JSON), scopes=SHEETS_SCOPES)
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    session.request = _observed_request(session.request)
+    return session
+
+
+def _sheets_op(method, url):
+    """Sheets APIのURLから操作名を作る(シート名・IDはラベルに入れない)"""
+    path = url.split("?", 1)[0]
+    for suffix, op in ((":batchGet", "batch_get"), (":append", "append"),
+                       (":batchUpdate", "batch_update"), (":clear", "clear")):
+        if path.endswith(suffix):
+            return op
+    if "/values/" in path:
+        return "read" if method.upper() == "GET" else "write"
+    return "metadata" if method.upper() == "GET" else "other"
+
+
+def _observed_request(request):
+    """セッションの全HTTP呼び出しを計測する(4xx・5xxの応答も失敗として数える)"""
+    def timed(method, url, *args, **kwargs):
+        op = _sheets_op(method, url)
+        started = time.monotonic()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception as e:
+            record_call("sheets", op, time.monotonic() - started, e)
+            raise
+        record_call("sheets", op, time.monotonic() - started,
+                    "HTTP %d" % resp.status_code if resp.status_code >= 400 else None)
+        return resp
+    return timed
+
+
 def _spreadsheet():
-    creds_dict = json.loads(GOOGLE_CREDS_JSON)
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    return gspread.authorize(creds).open_by_key(SPREADSHEET_ID)
+    with _sheets_lock:
+        if _sheets["spreadsheet"] is None:
+            if _sheets_client["client"] is None:
+                _sheets_client["client"] = gspread.Client(auth=None, session=_sheets_session())
+            _sheets["spreadsheet"] = _sheets_client["client"].open_by_key(
+                current_tenant()["spreadsheet_id"])
+        return _sheets["spreadsheet"]
 
 
 def _worksheet(name, rows="200", cols="10"):
+    ws = _sheets["worksheets"].get(name)
+    if ws is not None:
+        return ws
     sh = _spreadsheet()
     try:
-        return sh.worksheet(name)
+        ws = sh.worksheet(name)
     except gspread.WorksheetNotFound:
-        return sh.add_worksheet(title=name, rows=rows, cols=cols)
+        ws = sh.add_worksheet(title=name, rows=rows, cols=cols)
+    _sheets["worksheets"][name] = ws
+    return ws
+
+
+def _forget_worksheets():
+    """キャッシュしたワークシートを捨てる(シートの削除・改名に追従するため)。
+    クライアントと認証は残すので、次回はシート一覧の再取得だけで済む。"""
+    with _sheets_lock:
+        _sheets["spreadsheet"] = None
+        _sheets["worksheets"] = {}
+
+
+# ── ローカルDB(SQLite) ────────────────────────────────────
+# LOCAL_DB_PATH を設定したときだけ使う。接続はスレッドごと・診療科ごとに持つ
+# (ファイルは診療科ごとに分ける。_tenant_path を参照)。
+# 処理済みメッセージIDと取り込みジョブの状態は、同じdynoのワーカー間で共有しないと
+# 再送が別ワーカーに届いたときに二重に取り込むため、LOCAL_DB_PATH が無くても
+# WORKER_DB_PATH(dynoごとの /tmp)のSQLiteに置く。再起動で消えても困らない。
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "")
+WORKER_DB_PATH = os.getenv("WORKER_DB_PATH", "/tmp/toyosu-bot-worker.sqlite3")
+_db_local = threading.local()
+
+
+def _db(path=None):
+    """このスレッド・今の診療科用のSQLite接続(LOCAL_DB_PATH未設定ならNone)。
+    pathを渡すとそのファイルを使う(予定の履歴の索引用)"""
+    path = path or LOCAL_DB_PATH
+    if not path:
+        return None
+    path = _tenant_path(path)
+    conns = getattr(_db_local, "conns", None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_DB_SCHEMA)
+        conns[path] = conn
+    return conn
+
+
+def _worker_db():
+    """処理済みID・ジョブ用のSQLite接続(WORKER_DB_PATH も空ならNone)"""
+    return _db(LOCAL_DB_PATH or WORKER_DB_PATH)
+
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY, seen REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS processed_seen ON processed (seen);
+CREATE TABLE IF NOT EXISTS days (date TEXT PRIMARY KEY, assignment TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT, level TEXT, message TEXT);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created REAL NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS archive (date TEXT PRIMARY KEY, assignment TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS duties (
+    date TEXT, field TEXT, doctor TEXT, PRIMARY KEY (date, field)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS duties_doctor ON duties (doctor, date);
+CREATE TABLE IF NOT EXISTS metrics (
+    pid INTEGER PRIMARY KEY, boot TEXT NOT NULL, updated REAL NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS deliveries (
+    date TEXT, kind TEXT, target TEXT, status TEXT, at TEXT, retry_key TEXT,
+    PRIMARY KEY (date, kind, target));
+"""
 
 
-def load_schedule():
-    """{ "YYYY-MM-DD": {救急,AM院内,PM院内,AM医連,PM医連,残り番:[1st,2nd]} } を返す"""
+# ── 予定の保存(日付ごとの行) ──────────────────────────────
+# 予定は days シートに「日付 | 担当のJSON」で1日1行ずつ保存する。
+# 以前はscheduleシートA1のJSON1個に全日付を入れており、保存のたびに全体を
+# 読み直して書き戻していたため、取り込みとダッシュボード編集が重なると
+# 片方の更新が消えることがあった。今は変更した日付の行だけを書く。
+# scheduleシートには B1=配信済み日付、C1=リビジョン(保存のたびに新しい一意の値)を置く。
+# 番号を+1する方式だと、同じリビジョンから同時に保存した2つのワーカーが同じ値を書き、
+# 後の保存を知らないキャッシュが確認を通り続けたため、一致するかだけを見る。
+# A1に旧形式のJSONが残っていれば、最初の読み込み時に days シートへ移して空にする。
+#
+# 読み込みはプロセス内にキャッシュし、TTLが切れたらB1:C1(配信済み日付と
+# リビジョン)だけを読んで変化がなければ使い続ける。
+# gen はキャッシュを入れ替えるたびに進む番号(ダッシュボードのETag用)。
+SCHEDULE_CACHE_TTL = int(os.getenv("SCHEDULE_CACHE_TTL", "300"))   # 秒
+SCHEDULE_KEEP_DAYS = 7
+_schedule_lock = threading.RLock()
+_schedule_cache = _TenantState(lambda: {"data": None, "rev": None, "rows": {}, "checked": 0.0,
+                                         "delivered": None, "gen": 0})
+_schedule_stats = _TenantState(lambda: {"hit": 0, "revalidated": 0, "miss": 0})
+
+
+def _parse_schedule_blob(val):
+    if not val:
+        return {}
+    data = json.loads(val)
+    # 日付キー形式のみ受け付ける(旧・曜日形式のデータは無視)
+    return {k: v for k, v in data.items() if DATE_RE.match(str(k))}
+
+
+def _parse_revision(val):
+    try:
+        return int(val or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _new_revision():
+    return uuid.uuid4().hex[:16]
+
+
+def _store_schedule_cache(data, rev, rows):
+    _schedule_cache.update(data=data, rev=rev, rows=rows, checked=time.monotonic(),
+                           gen=_schedule_cache["gen"] + 1)
+
+
+def _read_schedule_revision():
+    head = list((_worksheet("schedule").get("B1:C1") or [[]])[0]) + ["", ""]
+    _schedule_cache["delivered"] = head[0] or ""
+    return str(head[1] or "")
+
+
+def _updated_rows(resp):
+    """append/update系APIの応答(updates.updatedRange)から (先頭行, 最終行) を得る"""
+    rng = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+    m = re.search(r"[A-Z]+(\d+)(?::[A-Z]+(\d+))?$", rng)
+    if not m:
+        return None, None
+    return int(m.group(1)), int(m.group(2) or m.group(1))
+
+
+def _day_row(date, assignment):
+    return [date, json.dumps(assignment, ensure_ascii=False)]
+
+
+def _apply_schedule_ranges(head_values, day_values):
+    """schedule!A1:C1 と days!A:B の読み込み結果をキャッシュに反映し、
+    (予定, 配信済み日付) を返す"""
+    head = list((head_values or [[]])[0]) + ["", "", ""]
+    rev = str(head[2] or "")
+    data, rows = {}, {}
+    for i, r in enumerate(day_values or [], start=1):
+        if len(r) >= 2 and DATE_RE.match(str(r[0])):
+            try:
+                data[r[0]] = json.loads(r[1])
+            except ValueError:
+                continue
+            rows[r[0]] = i   # 同じ日付が重複していたら後の行を採用
+    if head[0]:
+        rev = _migrate_legacy_schedule(head[0], data, rows, rev)
+    _store_schedule_cache(data, rev, rows)
+    _schedule_cache["delivered"] = head[1] or ""
+    return dict(data), head[1] or ""
+
+
+def _migrate_legacy_schedule(blob, data, rows, rev):
+    """A1の旧形式JSONを days シートへ移し、A1を空にする(1回だけ)"""
+    with _schedule_lock:
+        legacy = {d: a for d, a in _parse_schedule_blob(blob).items() if d not in data}
+        if legacy:
+            resp = _worksheet("days", cols="2").append_rows(
+                [_day_row(d, a) for d, a in sorted(legacy.items())], value_input_option="RAW")
+            first, _ = _updated_rows(resp)
+            for i, d in enumerate(sorted(legacy)):
+                data[d] = legacy[d]
+                if first:
+                    rows[d] = first + i
+        rev = _new_revision()
+        _spreadsheet().values_batch_update({"valueInputOption": "RAW", "data": [
+            {"range": "schedule!A1", "values": [[""]]},
+            {"range": "schedule!C1", "values": [[rev]]},
+        ]})
+    sys.stderr.write("旧形式の予定%d日分を days シートへ移行しました\n" % len(legacy))
+    return rev
+
+
+def _read_schedule_sheets():
+    _worksheet("schedule")   # 未作成なら作っておく(一括取得が失敗しないように)
+    _worksheet("days", cols="2")
+    resp = _spreadsheet().values_batch_get(["schedule!A1:C1", "days!A:B"])
+    head_range, day_range = resp.get("valueRanges", [])[:2]
+    return _apply_schedule_ranges(head_range.get("values"), day_range.get("values"))
+
+
+def _load_schedule_sheets(force=False, revalidate=False):
+    """スプレッドシートから予定を読む(キャッシュ付き)。
+    force=True でキャッシュを使わずに読み直す。
+    revalidate=True でTTL内でもリビジョンを確認する(書き込み前のマージ用)。"""
+    c = _schedule_cache
+    if not force and c["data"] is not None:
+        fresh = time.monotonic() - c["checked"] < SCHEDULE_CACHE_TTL
+        if fresh and not revalidate:
+            _schedule_stats["hit"] += 1
+            return dict(c["data"])
+        try:
+            if _read_schedule_revision() == c["rev"]:
+                c["checked"] = time.monotonic()
+                _schedule_stats["revalidated"] += 1
+                return dict(c["data"])
+        except Exception as e:
+            sys.stderr.write("リビジョン確認エラー: %s\n" % e)
+            _forget_worksheets()
+            if not revalidate:
+                return dict(c["data"])  # 確認できないときは手元の内容で続行
+    _schedule_stats["miss"] += 1
     try:
-        val = _worksheet("schedule").acell("A1").value
-        if val:
-            data = json.loads(val)
-            # 日付キー形式のみ受け付ける(旧・曜日形式のデータは無視)
-            return {k: v for k, v in data.items() if DATE_RE.match(str(k))}
+        return _read_schedule_sheets()[0]
     except Exception as e:
         sys.stderr.write("Sheets読み込みエラー: %s\n" % e)
+        _forget_worksheets()
+        if revalidate:
+            raise   # 保存前のマージでは、読めないまま書き込まない
     return {}
 
 
-def save_schedule(new_days):
-    """既存データとマージして保存。7日以上前の日付は削除する。"""
-    data = load_schedule()
-    data.update(new_days)
-    cutoff = (now_jst().date() - datetime.timedelta(days=7)).isoformat()
-    data = {d: a for d, a in sorted(data.items()) if d >= cutoff}
-    _worksheet("schedule").update("A1", [[json.dumps(data, ensure_ascii=False)]])
-    return data
+def _save_schedule_sheets(new_days):
+    """スプレッドシートの予定を日付ごとに追加・上書きする(変更した日付の行だけを書く)。
+    7日以上前の日付は archive シートへ移してから行ごと削除する。リビジョンを進め、キャッシュも書き換える。"""
+    cutoff = (now_jst().date() - datetime.timedelta(days=SCHEDULE_KEEP_DAYS)).isoformat()
+    new_days = {d: a for d, a in new_days.items() if d >= cutoff}
+    with _schedule_lock:
+        data = _load_schedule_sheets(revalidate=True)
+        rows = dict(_schedule_cache["rows"])
+        rev = _new_revision()
+        updates = [{"range": "days!A%d:B%d" % (rows[d], rows[d]), "values": [_day_row(d, a)]}
+                   for d, a in sorted(new_days.items()) if d in rows]
+        appends = [_day_row(d, a) for d, a in sorted(new_days.items()) if d not in rows]
+        first = None
+        if appends:
+            resp = _worksheet("days", cols="2").append_rows(appends, value_input_option="RAW")
+            first, _ = _updated_rows(resp)
+            for i, r in enumerate(appends):
+                rows[r[0]] = (first or 0) + i
+        # 既存行の上書きとリビジョン更新は1回のAPI呼び出しで行う
+        _spreadsheet().values_batch_update({"valueInputOption": "RAW", "data": updates + [
+            {"range": "schedule!C1", "values": [[rev]]},
+        ]})
+        data.update(new_days)
+        _store_schedule_cache(data, rev, rows)
+        if appends and not first:
+            _schedule_cache["data"] = None   # 追記先の行番号が分からない → 次回読み直す
+            return data
+        try:
+            _prune_schedule(cutoff)
+        except Exception as e:
+            # 保存自体は済んでいるので、削除は次回の保存に任せる
+            sys.stderr.write("古い予定の削除エラー: %s\n" % e)
+            _forget_worksheets()
+    return dict(_schedule_cache["data"] or data)
+
+
+def _prune_schedule(cutoff):
+    """cutoffより前の日付の行(と重複した古い行)を削除する。
+    行番号はキャッシュではなく読み直した日付の列で決める(別プロセスが直前に
+    追記した行を消さないため)。重複は、同じ日付がもっと下の行にもある行だけ
+    (読み込みは後の行を採用する)。行番号がずれるのでリビジョンを進め、
+    他のプロセスに読み直させる。"""
+    data = _schedule_cache["data"]
+    if not any(d < cutoff for d in _schedule_cache["rows"]):
+        return   # 消す日付がなければ列も読まない(重複の掃除は次に消すときにまとめて)
+    values = _worksheet("days", cols="2").col_values(1)
+    last = {}
+    for i, v in enumerate(values, start=1):
+        if DATE_RE.match(v):
+            last[v] = i
+    dated = [(i, v) for i, v in enumerate(values, start=1) if DATE_RE.match(v)]
+    dup = [i for i, v in dated if last[v] > i]
+    # 中身を知らない(キャッシュにない)古い日付は、履歴に残せないので次回に回す
+    old = [i for i, v in dated if v < cutoff and last[v] == i and v in data]
+    doomed = sorted(set(old + dup), reverse=True)
+    if not doomed:
+        return
+    aged = {v: data[v] for i, v in dated if i in old}
+    if aged:
+        archive_days(aged)   # 履歴に残せなければ消さない(次回の保存でやり直す)
+    ws = _worksheet("days", cols="2")
+    _spreadsheet().batch_update({"requests": [
+        {"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS",
+                                       "startIndex": r - 1, "endIndex": r}}}
+        for r in doomed  # 下の行から消せば、上の行番号は変わらない
+    ]})
+    gone = set(doomed)
+    new_rows = {v: i - sum(1 for x in doomed if x < i)
+                for v, i in last.items() if i not in gone}
+    kept = {d: a for d, a in data.items() if d in new_rows}
+    rev = _new_revision()
+    _worksheet("schedule").update("C1", [[rev]])
+    _store_schedule_cache(kept, rev, new_rows)
+    if set(kept) != set(new_rows):
+        _schedule_cache["data"] = None   # 別プロセスが追記した日付がある → 次回読み直す
+
+
+def schedule_cache_stats():
+    total = sum(_schedule_stats.values())
+    hits = _schedule_stats["hit"] + _schedule_stats["revalidated"]
+    return dict(_schedule_stats, revision=_schedule_cache["rev"], local=bool(LOCAL_DB_PATH),
+                hit_rate=round(hits / total, 3) if total else None)
 
 
 def _sheet_write_retry(action, desc, attempts=3):
@@ -101,49 +730,705 @@ def _sheet_write_retry(action, desc, attempts=3):
             return True
         except Exception as e:
             sys.stderr.write("%s 失敗(%d回目): %s\n" % (desc, i + 1, e))
+            _forget_worksheets()
             if i < attempts - 1:
+                record_retry("sheets", "write")
                 time.sleep(2 * (i + 1))
     return False
 
 
+# ── ダッシュボードへの変更通知 ─────────────────────────────
+# ログ・予定・配信記録・取り込みジョブが変わったら publish() で知らせ、
+# /api/events(Server-Sent Events)で接続中のダッシュボードへ流す。
+# 受け手ごとに小さなキューを持ち、溢れたら古い通知は捨てる(通知は
+# 「読み直して」の合図なので、取りこぼしても次の通知か定期取得で追いつく)。
+EVENT_QUEUE_MAX = 50
+_event_subs = []
+_event_lock = threading.Lock()
+
+
+def publish(kind, data=None):
+    """今の診療科のダッシュボードへ通知する"""
+    tid = current_tenant()["id"]
+    msg = (kind, data or {})
+    with _event_lock:
+        subs = [q for t, q in _event_subs if t == tid]
+    for q in subs:
+        try:
+            q.put_nowait(msg)
+        except queue.Full:
+            pass
+
+
+def subscribe(limit):
+    """通知の受け口(キュー)を登録する。受け手がlimit人を超えるならNone"""
+    with _event_lock:
+        if len(_event_subs) >= limit:
+            return None
+        q = queue.Queue(maxsize=EVENT_QUEUE_MAX)
+        _event_subs.append((current_tenant()["id"], q))
+        return q
+
+
+def unsubscribe(q):
+    with _event_lock:
+        _event_subs[:] = [(t, x) for t, x in _event_subs if x is not q]
+
+
+# ── ログの非同期書き込み ─────────────────────────────────
+# log_event() は行をキューに積むだけにし、書き込み専用スレッドが
+# 溜まった行を append_rows 1回にまとめて書く。リトライ待ち(最大6秒)で
+# /trigger-daily の応答や取り込みスレッドを止めないため。
+# Sheetsに書けなかった行はローカルファイルに退避し、次に書けたときに古い順に
+# LOG_BATCH_MAX 行ずつ送る(送れた分はその都度ファイルから消す)。書けなかった直後の
+# LOG_FALLBACK_RETRY 秒は退避だけして、落ちているSheetsを叩き続けない。
+# 退避は LOG_FALLBACK_MAX 行までで、超えたら古い行から捨てる。
+# 退避ファイルは全ワーカーで共有するので、読み書きは <ファイル名>.lock で排他する
+# (再送と切り詰めが重なって、同じ行を二重に送ったり足したばかりの行を消したりしないように)。
+# 配信記録(mark_delivered)は二重配信防止の要なので同期書き込みのまま。
+# キューには (診療科, 行) を積み、書き込みスレッドは診療科ごとにまとめて書く。
+LOG_FALLBACK_PATH = os.getenv("LOG_FALLBACK_PATH", "log_fallback.jsonl")
+LOG_FALLBACK_MAX = 5000
+LOG_FALLBACK_RETRY = 60   # 秒
+LOG_BATCH_DELAY = 1.0   # 最初の1行が来てから、まとめて書くまで待つ秒数
+LOG_BATCH_MAX = 100
+_log_queue = queue.Queue()
+_log_writer = {"thread": None}
+_log_writer_lock = threading.Lock()
+_log_pending = {"rows": 0}   # キューに積んでからまだ書き終えていない行数
+_log_done = threading.Condition()
+_log_fallback_state = _TenantState(lambda: {"failed_at": None})
+
+
 def log_event(level, message):
-    """log シートに1行追記(失敗してもbot本体は止めない)"""
+    """log シートに1行追記(書き込みはバックグラウンド。失敗してもbot本体は止めない)"""
+    if level == "エラー" and current_trace():
+        message = "%s [trace %s]" % (message, current_trace())
     row = [now_jst().strftime("%Y-%m-%d %H:%M"), level, message]
-    _sheet_write_retry(
-        # RAW指定: Sheetsが日時文字列を勝手に日付型に変換して表示形式を変えるのを防ぐ
-        lambda: _worksheet("log").append_row(row, value_input_option="RAW"),
-        "ログ記録",
-    )
+    db = _local_store()
+    if db is not None:
+        _local_insert_logs(db, [row])
+        publish("log", {"level": level})   # Sheets版は書き込めてから知らせる
+    with _log_done:
+        _log_pending["rows"] += 1
+    _log_queue.put((current_tenant(), row))
+    _ensure_log_writer()
+
+
+def _ensure_log_writer():
+    with _log_writer_lock:
+        t = _log_writer["thread"]
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=_log_writer_loop, name="log-writer", daemon=True)
+            t.start()
+            _log_writer["thread"] = t
+
+
+def _log_writer_loop():
+    while True:
+        rows = [_log_queue.get()]
+        time.sleep(LOG_BATCH_DELAY)
+        while len(rows) < LOG_BATCH_MAX:
+            try:
+                rows.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        by_tenant = collections.OrderedDict()
+        for tenant, row in rows:
+            by_tenant.setdefault(tenant["id"], (tenant, []))[1].append(row)
+        for tenant, tenant_rows in by_tenant.values():
+            try:
+                with use_tenant(tenant):
+                    _write_log_rows(tenant_rows)
+            except Exception as e:
+                sys.stderr.write("ログ書き込みスレッドのエラー(%s): %s\n" % (tenant["id"], e))
+        with _log_done:
+            _log_pending["rows"] -= len(rows)
+            _log_done.notify_all()
+
+
+def _read_log_fallback():
+    try:
+        with open(_tenant_path(LOG_FALLBACK_PATH), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        sys.stderr.write("退避ログ読み込みエラー: %s\n" % e)
+        return []
+
+
+def _rewrite_log_fallback(rows):
+    path = _tenant_path(LOG_FALLBACK_PATH)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def _send_log_fallback():
+    """退避した行を古い順に送る。送れた分はその都度ファイルから消す。全部送れたらTrue"""
+    with _file_lock(_tenant_path(LOG_FALLBACK_PATH) + ".lock"):
+        pending = _read_log_fallback()
+        while pending:
+            chunk = pending[:LOG_BATCH_MAX]
+            if not _sheet_write_retry(lambda: _append_log_rows(chunk), "退避ログの再送"):
+                return False
+            pending = pending[LOG_BATCH_MAX:]
+            _rewrite_log_fallback(pending)
+    return True
+
+
+def _save_log_fallback(rows):
+    with _file_lock(_tenant_path(LOG_FALLBACK_PATH) + ".lock"):
+        pending = _read_log_fallback() + rows
+        if len(pending) > LOG_FALLBACK_MAX:
+            sys.stderr.write("退避ログが上限を超えたため古い%d行を捨てます\n" % (len(pending) - LOG_FALLBACK_MAX))
+            pending = pending[-LOG_FALLBACK_MAX:]
+        _rewrite_log_fallback(pending)
+
+
+def _write_log_rows(rows):
+    failed_at = _log_fallback_state["failed_at"]
+    if failed_at is None or time.monotonic() - failed_at >= LOG_FALLBACK_RETRY:
+        # 退避分を先に送り、時系列の順を保つ
+        if _send_log_fallback() and _sheet_write_retry(lambda: _append_log_rows(rows), "ログ記録"):
+            _log_fallback_state["failed_at"] = None
+            if not LOCAL_DB_PATH:
+                publish("log", {"level": rows[-1][1]})
+            return
+        _log_fallback_state["failed_at"] = time.monotonic()
+    _save_log_fallback(rows)
+
+
+def flush_logs(timeout=15):
+    """キューに残っているログを書き終えるまで待つ(終了時用)。書き終えたらTrue"""
+    with _log_done:
+        return _log_done.wait_for(lambda: _log_pending["rows"] <= 0, timeout)
 
 
 def mark_delivered(date_str):
-    """配信済み日付をscheduleシートのB1セルに記録(配信判定の正式な記録)"""
-    _sheet_write_retry(
+    """配信済み日付をscheduleシートのB1セルに記録(配信判定の正式な記録)。
+    ローカルDBを使っていても、ほかのdynoから見えるようSheetsへは同期で書く。"""
+    db = _local_store()
+    if db is not None:
+        _meta_set(db, "delivered", date_str)
+    if _sheet_write_retry(
         lambda: _worksheet("schedule").update("B1", [[date_str]]),
         "配信記録",
-    )
+    ):
+        _schedule_cache["delivered"] = date_str
+    publish("delivered", {"date": date_str})
 
 
 def load_delivered_date():
+    db = _local_store()
+    if db is not None:
+        return _meta_get(db, "delivered")
     try:
         return _worksheet("schedule").acell("B1").value or ""
     except Exception as e:
         sys.stderr.write("配信記録読み込みエラー: %s\n" % e)
+        _forget_worksheets()
         return ""
 
 
+# ── ログの末尾読み込みと月別アーカイブ ────────────────────
+# logシートは追記されるだけなので、全件取得すると運用年数に比例して重くなる。
+# 行数を覚えておき、末尾の範囲(A{n-29}:C)だけを読む。行数は追記の応答から
+# 更新し、初回だけA列を数える。古い月の行は週1回 log_YYYY-MM シートへ移す。
+#
+# ダッシュボードは「ログ番号」(log_seq)より後の行だけを取りに来る。
+# ローカルDBでは logs.id、Sheetsでは「アーカイブで移した行数 + 行番号」を使う。
+LOG_KEEP_ROWS = 30   # アーカイブ後もlogシートに残す最低行数(ダッシュボード表示分)
+_log_lock = threading.Lock()
+# rows: logシートの行数(未確認ならNone)、base: このプロセスでアーカイブした行数、
+# checked: 行数をシートで確かめた時刻(追記の応答・末尾の読み込みでも更新する)
+_log_state = _TenantState(lambda: {"rows": None, "base": 0, "checked": 0.0})
+
+
+def _append_log_rows(rows):
+    # RAW指定: Sheetsが日時文字列を勝手に日付型に変換して表示形式を変えるのを防ぐ
+    resp = _worksheet("log").append_rows(rows, value_input_option="RAW")
+    _, last = _updated_rows(resp)
+    if last:
+        _log_state.update(rows=last, checked=time.monotonic())
+
+
+def _log_row_count():
+    if _log_state["rows"] is None:
+        _log_state.update(rows=len(_worksheet("log").col_values(1)), checked=time.monotonic())
+    return _log_state["rows"]
+
+
+def _log_tail_range(limit):
+    """末尾limit行を読む範囲。終端を開けておくので、他プロセスの追記分も取れる"""
+    n = _log_state["rows"]
+    if n is None:
+        return "A:C"
+    return "A%d:C" % max(1, n - limit + 1)
+
+
+def _note_tail_read(rng, rows):
+    start = int(re.match(r"A(\d+)", rng).group(1)) if rng != "A:C" else 1
+    _log_state.update(rows=start - 1 + len(rows), checked=time.monotonic())
+
+
+def _rows_to_logs(rows, limit=30):
+    return [
+        {"time": r[0], "level": r[1], "message": r[2]}
+        for r in rows[-limit:] if len(r) >= 3
+    ][::-1]  # 新しい順
+
+
 def load_logs(limit=30):
+    db = _local_store()
+    if db is not None:
+        return _local_logs(db, limit)
+    return _load_logs_sheets(limit)
+
+
+def log_seq():
+    """最新のログ番号(ローカルDBまたはSheetsの行数から)。
+    Sheetsの行数は追記・末尾の読み込みのたびに更新し、それ以外で他ワーカーの追記分を
+    数え直すのは SCHEDULE_CACHE_TTL に1回だけ(ダッシュボードの304はシートを読まない)"""
+    db = _local_store()
+    if db is not None:
+        return db.execute("SELECT COALESCE(MAX(id), 0) FROM logs").fetchone()[0]
+    if _log_state["rows"] is not None and time.monotonic() - _log_state["checked"] >= SCHEDULE_CACHE_TTL:
+        try:
+            _log_state.update(rows=len(_worksheet("log").col_values(1)), checked=time.monotonic())
+        except Exception as e:
+            sys.stderr.write("ログ行数の確認エラー: %s\n" % e)   # 手元の行数のまま
+            _forget_worksheets()
+    return _log_state["base"] + _log_row_count()
+
+
+def _logs_since(logs, seq, since):
+    """新しい順のログ(先頭がseq番)から、since より後の分を切り出す。(ログ, seq, 全件か)"""
+    if since is not None and 0 <= seq - since <= len(logs):
+        return logs[:seq - since], seq, False
+    return logs, seq, True
+
+
+def load_logs_since(since, limit=30):
+    """ログ番号 since より後のログを新しい順に返す。(ログ, 最新のログ番号, 全件か)
+    since が無い・古すぎる・アーカイブで番号がずれた場合は末尾limit件を返し、
+    3つ目をTrueにする(呼び出し側は手元のログを置き換える)。
+    Sheetsでは末尾を1回読んで切り出す(終端を開けた範囲なので他ワーカーの追記分も見える)。"""
+    db = _local_store()
+    if db is not None:
+        seq = log_seq()
+        if since is None or not seq - limit <= since <= seq:
+            return _local_logs(db, limit), seq, True
+        rows = db.execute("SELECT time, level, message FROM logs WHERE id > ? ORDER BY id DESC",
+                          (since,))
+        return [{"time": t, "level": l, "message": m} for t, l, m in rows], seq, False
+    logs = _load_logs_sheets(limit)
+    return _logs_since(logs, _log_state["base"] + (_log_state["rows"] or 0), since)
+
+
+def _load_logs_sheets(limit=30):
     try:
-        rows = _worksheet("log").get_all_values()
-        return [
-            {"time": r[0], "level": r[1], "message": r[2]}
-            for r in rows[-limit:] if len(r) >= 3
-        ][::-1]  # 新しい順
+        _log_row_count()
+        rng = _log_tail_range(limit)
+        rows = _worksheet("log").get(rng)
+        if not rows and _log_state["rows"]:
+            # アーカイブで行が減っていた → 数え直して読み直す
+            _log_state["rows"] = None
+            _log_row_count()
+            rng = _log_tail_range(limit)
+            rows = _worksheet("log").get(rng)
+        _note_tail_read(rng, rows)
+        return _rows_to_logs(rows, limit)
     except Exception as e:
         sys.stderr.write("ログ読み込みエラー: %s\n" % e)
+        _forget_worksheets()
+        _log_state["rows"] = None
         return []
 
 
+def rotate_logs():
+    """先月以前のログ行を月別のアーカイブシート(log_YYYY-MM)へ移す。
+    ログは時系列に追記されるので、古い月の行は必ず先頭にまとまっている。"""
+    this_month = now_jst().strftime("%Y-%m")
+    with _log_lock:
+        ws = _worksheet("log")
+        rows = ws.get_all_values()
+        by_month, month, k = {}, None, 0
+        for r in rows[:max(0, len(rows) - LOG_KEEP_ROWS)]:
+            date = _log_date(r[0]) if r else None
+            month = date[:7] if date else month   # 日時が読めない行は直前の行と同じ月
+            if month is None or month >= this_month:
+                break
+            by_month.setdefault(month, []).append(r[:3])
+            k += 1
+        if not k:
+            return 0
+        for m, month_rows in sorted(by_month.items()):
+            _worksheet("log_" + m, rows=str(len(month_rows) + 10), cols="3").append_rows(
+                month_rows, value_input_option="RAW")
+        ws.delete_rows(1, k)
+        _log_state["rows"] = len(rows) - k
+        _log_state["base"] += k   # ログ番号は変えない
+        db = _db()
+        if db is not None:   # ローカルのログも直近分だけ残す
+            db.execute("DELETE FROM logs WHERE id <= (SELECT MAX(id) FROM logs) - 1000")
+    log_event("確認", "ログ%d行を月別シートへアーカイブ" % k)
+    return k
+
+
+# ── ローカル優先の保存(SQLite) ───────────────────────────
+# LOCAL_DB_PATH を設定すると、予定・配信済み日付・ログの正本をローカルのSQLiteに
+# 置き、読み込みはすべてローカルから行う(朝の配信判定がSheetsの遅延や
+# クォータに左右されない)。書き込みはバックグラウンドでSheetsへ複製し、
+# スプレッドシートは人が見るための表示として最新に保つ。
+# 起動後の最初のアクセスで、複製しきれなかった変更をSheetsへ送り直してから
+# Sheetsの内容を取り込む(dynoの再起動でディスクが消えても元に戻せる)。
+# gunicornで複数ワーカーが同じDBを使うときは、起動ごとのID(BOT_BOOT_ID)で
+# 突き合わせ済みかを見て、最初のワーカーだけが行う。
+BOOT_ID = os.getenv("BOT_BOOT_ID", "")
+_local_state = _TenantState(lambda: {"reconciled": False})
+_local_lock = threading.Lock()
+_replica_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replica")
+
+
+def _local_store():
+    """ローカルDBの接続(未使用ならNone)。初回はSheetsとの突き合わせを行う"""
+    db = _db()
+    if db is not None and not _local_state["reconciled"]:
+        with _local_lock:
+            if not _local_state["reconciled"]:
+                _local_state["reconciled"] = True
+                if BOOT_ID and _meta_get(db, "boot_id") == BOOT_ID:
+                    return db   # 同じ起動の別ワーカーが突き合わせ済み
+                try:
+                    reconcile_local_store()
+                except Exception as e:
+                    # Sheetsが落ちていても、手元のデータで動き続ける
+                    sys.stderr.write("ローカルDBの突き合わせエラー: %s\n" % e)
+                    _forget_worksheets()
+    return db
+
+
+def _meta_get(db, key):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else ""
+
+
+def _meta_set(db, key, value):
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def _local_schedule(db):
+    return {d: json.loads(a) for d, a in db.execute("SELECT date, assignment FROM days")}
+
+
+def _local_logs(db, limit):
+    rows = db.execute("SELECT time, level, message FROM logs ORDER BY id DESC LIMIT ?", (limit,))
+    return [{"time": t, "level": l, "message": m} for t, l, m in rows]
+
+
+def _local_insert_logs(db, rows):
+    db.executemany("INSERT INTO logs (time, level, message) VALUES (?, ?, ?)",
+                   [tuple(r[:3]) for r in rows])
+
+
+@contextlib.contextmanager
+def _db_transaction(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def _local_save_schedule(db, new_days):
+    """ローカルに保存し、複製待ちの印(dirty)としてこの保存の番号を返す"""
+    cutoff = (now_jst().date() - datetime.timedelta(days=SCHEDULE_KEEP_DAYS)).isoformat()
+    with _db_transaction(db):
+        db.executemany("INSERT OR REPLACE INTO days (date, assignment) VALUES (?, ?)",
+                       [_day_row(d, a) for d, a in new_days.items() if d >= cutoff])
+        # 消す日付は履歴の索引へ(archive シートへはSheetsへの複製時に追記される)
+        aged = db.execute("SELECT date, assignment FROM days WHERE date < ?", (cutoff,)).fetchall()
+        _index_archive(db, {d: json.loads(a) for d, a in aged})
+        db.execute("DELETE FROM days WHERE date < ?", (cutoff,))
+        seq = _parse_revision(_meta_get(db, "local_rev")) + 1
+        _meta_set(db, "local_rev", seq)
+        _meta_set(db, "dirty", seq)   # Sheetsへの複製が済むまで立てておく
+    return seq
+
+
+def _replicate_schedule(new_days, seq):
+    """ローカルで保存した予定をSheetsへ複製する(複製用スレッドで1件ずつ実行)。
+    前回の複製に失敗していたら、ローカルの予定をまとめて送り直す。"""
+    db = _db()
+    if _meta_get(db, "replica_failed"):
+        new_days = _local_schedule(db)
+    tries = {"n": 0}
+
+    def save():
+        if tries["n"]:
+            # 前回の試行で追記だけ済んでいたら、その行を上書きする(同じ日付を追記し直さない)
+            _load_schedule_sheets(force=True)
+        tries["n"] += 1
+        _save_schedule_sheets(new_days)
+    if _sheet_write_retry(save, "予定の複製"):
+        with _db_transaction(db):
+            _meta_set(db, "replica_failed", "")
+            if _meta_get(db, "dirty") == str(seq):   # これより新しい保存がなければ複製完了
+                _meta_set(db, "dirty", "")
+    else:
+        _meta_set(db, "replica_failed", "1")
+
+
+def reconcile_local_store():
+    """ローカルDBとSheetsを突き合わせる。
+    (1) 未複製の変更が残っていればSheetsへ送る(日付ごとの上書きなので他の日付は消さない)
+    (2) Sheetsの予定を正としてローカルへ取り込む
+    (3) 配信済み日付は新しい方、ログはローカルが空ならSheetsの末尾を取り込む"""
+    db = _db()
+    if _meta_get(db, "dirty"):
+        _save_schedule_sheets(_local_schedule(db))
+    schedule, delivered = _read_schedule_sheets()
+    with _db_transaction(db):
+        db.execute("DELETE FROM days")
+        db.executemany("INSERT INTO days (date, assignment) VALUES (?, ?)",
+                       [_day_row(d, a) for d, a in schedule.items()])
+        _meta_set(db, "delivered", max(delivered, _meta_get(db, "delivered")))
+        _meta_set(db, "dirty", "")
+        _meta_set(db, "replica_failed", "")
+        _meta_set(db, "reconciled_at", now_jst().strftime("%Y-%m-%d %H:%M"))
+        _meta_set(db, "boot_id", BOOT_ID)
+    if not db.execute("SELECT 1 FROM logs LIMIT 1").fetchone():
+        logs = _load_logs_sheets()
+        _local_insert_logs(db, [[l["time"], l["level"], l["message"]] for l in logs[::-1]])
+    sys.stderr.write("ローカルDBをSheetsと突き合わせました(%d日分)\n" % len(schedule))
+
+
+def load_schedule(force=False, revalidate=False):
+    """{ "YYYY-MM-DD": {救急,AM院内,PM院内,AM医連,PM医連,残り番:[1st,2nd]} } を返す
+    force=True で読み直す(ローカルDB使用時はSheetsから取り込み直す)。"""
+    db = _local_store()
+    if db is None:
+        return _load_schedule_sheets(force, revalidate)
+    if force:
+        try:
+            with _local_lock:
+                reconcile_local_store()
+        except Exception as e:
+            sys.stderr.write("ローカルDBの突き合わせエラー: %s\n" % e)
+            _forget_worksheets()
+    return _local_schedule(db)
+
+
+def save_schedule(new_days):
+    """日付ごとに追加・上書きする。7日以上前の日付は履歴(archive)へ移して削除する。
+    ローカルDB使用時はローカルに書いて、Sheetsへはバックグラウンドで複製する。"""
+    db = _local_store()
+    if db is None:
+        data = _save_schedule_sheets(new_days)
+        publish("schedule", {"dates": sorted(new_days)})
+        return data
+    seq = _local_save_schedule(db, new_days)
+    publish("schedule", {"dates": sorted(new_days)})
+    try:
+        # 複製用スレッドでも同じ診療科のシート・DBを使うよう、contextvarを引き継ぐ
+        _replica_pool.submit(contextvars.copy_context().run, _replicate_schedule, dict(new_days), seq)
+    except RuntimeError:   # 終了処理中は、消えてしまう前にこの場で複製する
+        _replicate_schedule(dict(new_days), seq)
+    return _local_schedule(db)
+
+
+def load_trigger_snapshot():
+    """配信判定に必要な 予定・配信済み日付・ログ を values:batchGet 1回で読む。
+    個別に読むと schedule!B1 → log!A:C → 予定 の3往復になり、
+    APIが遅い朝はその分だけ配信が遅れる。読めた予定はキャッシュにも反映する。
+    ローカルDBを使っているときはSheetsに触れずにローカルから返す。"""
+    db = _local_store()
+    if db is not None:
+        return {
+            "schedule": _local_schedule(db),
+            "delivered": _meta_get(db, "delivered"),
+            "logs": _local_logs(db, 30),
+        }
+    try:
+        _worksheet("schedule")   # 未作成のシートがあると一括取得が失敗するため
+        _worksheet("days", cols="2")
+        _worksheet("log")
+        log_rng = _log_tail_range(30)
+        resp = _spreadsheet().values_batch_get(
+            ["schedule!A1:C1", "days!A:B", "log!" + log_rng])
+        head_range, day_range, log_range = resp.get("valueRanges", [])[:3]
+        log_rows = log_range.get("values") or []
+        if not log_rows and _log_state["rows"]:
+            raise ValueError("ログの行数が変わっています")   # アーカイブ直後など
+        schedule, delivered = _apply_schedule_ranges(
+            head_range.get("values"), day_range.get("values"))
+        _note_tail_read(log_rng, log_rows)
+        return {
+            "schedule": schedule,
+            "delivered": delivered,
+            "logs": _rows_to_logs(log_rows),
+        }
+    except Exception as e:
+        # 一括取得できないときは個別読み込みに戻す
+        sys.stderr.write("一括読み込みエラー: %s\n" % e)
+        _forget_worksheets()
+        return {
+            "schedule": load_schedule(),
+            "delivered": load_delivered_date(),
+            "logs": load_logs(),
+        }
+
+
+# ── 予定の履歴(アーカイブと集計) ───────────────────────────
+# 予定は SCHEDULE_KEEP_DAYS 日を過ぎると days シート・ローカルDBから消えるため、
+# 「この四半期に誰が何回残り番をしたか」が分からなかった。消す前に
+# archive シートへ「日付 | 担当のJSON | 記録日時」を追記し(追記のみ。こちらが正本)、
+# SQLiteの索引(日付ごとの archive 表と、担当欄・医師名ごとの duties 表)にも入れる。
+# 集計(/api/archive/*)は索引だけを読み、予定の読み書きには触れない。
+# 索引はローカルDB(LOCAL_DB_PATH)、未設定なら ARCHIVE_DB_PATH に置く。
+# 索引に入れたシートの行数を meta に持ち、集計のときにシートの行数と照合して、
+# 違えば(dynoの再起動で消えた・ほかのdynoが追記した・索引への書き込みに失敗した)
+# archive シートから作り直す。
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "/tmp/toyosu-bot-archive.sqlite3")
+ARCHIVE_RANGE_DAYS = 91   # 集計期間を省略したとき(約3か月)
+ARCHIVE_CHECK_INTERVAL = 600   # 秒。シートの行数との照合はこの間隔で
+DUTY_FIELDS = FIELDS + ["残り番1st", "残り番2nd"]
+_NOT_A_DOCTOR = {"", "未設定", "−", "-", "なし"}
+_archive_state = _TenantState(lambda: {"checked_at": None})
+
+
+def _archive_db():
+    return _db(LOCAL_DB_PATH or ARCHIVE_DB_PATH)
+
+
+def _duty_rows(date, assignment):
+    """1日分の担当を (日付, 担当欄, 医師名) の行にする(空欄・未設定は除く)"""
+    first, second = (list(assignment.get("残り番") or []) + ["", ""])[:2]
+    slots = [(f, assignment.get(f)) for f in FIELDS] + [("残り番1st", first), ("残り番2nd", second)]
+    return [(date, f, str(name).strip()) for f, name in slots
+            if str(name or "").strip() not in _NOT_A_DOCTOR]
+
+
+def _index_archive(db, days):
+    """{date: assignment} を索引へ入れる(同じ日付は置き換え)。トランザクションは呼び出し元で"""
+    db.executemany("INSERT OR REPLACE INTO archive (date, assignment) VALUES (?, ?)",
+                   [_day_row(d, a) for d, a in days.items()])
+    db.executemany("DELETE FROM duties WHERE date = ?", [(d,) for d in days])
+    db.executemany("INSERT INTO duties (date, field, doctor) VALUES (?, ?, ?)",
+                   [r for d, a in sorted(days.items()) for r in _duty_rows(d, a)])
+
+
+def archive_days(days):
+    """予定から消す日付を archive シートへ追記し、索引にも入れる。
+    シートへ書けなければ例外を投げる(呼び出し元は削除を見送る)"""
+    at = now_jst().strftime("%Y-%m-%d %H:%M")
+    _worksheet("archive", cols="3").append_rows(
+        [_day_row(d, a) + [at] for d, a in sorted(days.items())], value_input_option="RAW")
+    try:
+        db = _archive_db()
+        with _db_transaction(db):
+            _index_archive(db, days)
+            _meta_set(db, "archive_rows", int(_meta_get(db, "archive_rows") or 0) + len(days))
+    except sqlite3.Error as e:
+        # シートには残っている。行数が合わなくなるので、次の集計で作り直される
+        sys.stderr.write("履歴の索引エラー: %s\n" % e)
+        _archive_state["checked_at"] = None
+
+
+def rebuild_archive_index(db):
+    """archive シートから索引を作り直す。同じ日付が複数あれば後の行を使う"""
+    days = {}
+    rows = _worksheet("archive", cols="3").get_all_values()
+    for r in rows:
+        if len(r) > 1 and DATE_RE.match(r[0]):
+            try:
+                days[r[0]] = json.loads(r[1])
+            except ValueError:
+                continue
+    with _db_transaction(db):
+        _index_archive(db, days)
+        _meta_set(db, "archive_rows", len(rows))
+    sys.stderr.write("履歴の索引を作り直しました(%d日分)\n" % len(days))
+    return len(days)
+
+
+def _archive_index():
+    """集計用の索引。索引に入れた行数が archive シートの行数と違えば作り直す
+    (照合はプロセスごと・診療科ごとに ARCHIVE_CHECK_INTERVAL 秒に1回)"""
+    db = _archive_db()
+    at = _archive_state["checked_at"]
+    if at is None or time.monotonic() - at >= ARCHIVE_CHECK_INTERVAL:
+        rows = len(_worksheet("archive", cols="3").col_values(1))
+        if str(rows) != _meta_get(db, "archive_rows"):
+            rebuild_archive_index(db)   # 失敗したら次の集計でもう一度試す
+        _archive_state["checked_at"] = time.monotonic()
+    return db
+
+
+def archive_coverage(start, end):
+    """期間内に履歴がある日数と最初・最後の日付"""
+    n, first, last = _archive_index().execute(
+        "SELECT COUNT(*), MIN(date), MAX(date) FROM archive WHERE date BETWEEN ? AND ?",
+        (start, end)).fetchone()
+    return {"from": start, "to": end, "days": n, "first": first, "last": last}
+
+
+def _duty_fields(field):
+    """担当欄の指定を索引の欄名にする(「残り番」は1st・2ndの両方。知らない欄は無し)"""
+    if field == "残り番":
+        return ["残り番1st", "残り番2nd"]
+    return [field] if field in DUTY_FIELDS else []
+
+
+def duty_counts(start, end, field=None, doctor=None):
+    """医師ごとの担当回数(多い順)。fieldは担当欄の名前か「残り番」(1st・2ndの両方)"""
+    sql = "SELECT doctor, field, COUNT(*) FROM duties WHERE date BETWEEN ? AND ?"
+    args = [start, end]
+    if field:
+        fields = _duty_fields(field)
+        sql += " AND field IN (%s)" % ", ".join("?" * len(fields)) if fields else " AND 0"
+        args += fields
+    if doctor:
+        sql += " AND doctor = ?"
+        args.append(doctor)
+    doctors = {}
+    for name, f, n in _archive_index().execute(sql + " GROUP BY doctor, field", args):
+        d = doctors.setdefault(name, {"doctor": name, "total": 0, "fields": {}})
+        d["fields"][f] = n
+        d["total"] += n
+    return sorted(doctors.values(), key=lambda d: (-d["total"], d["doctor"]))
+
+
+def duty_fairness(start, end, field=None):
+    """担当欄ごとの偏り。その欄を1回以上担当した医師の間での回数の
+    平均・標準偏差・変動係数(標準偏差/平均)と、最多・最少の医師"""
+    per_field = collections.OrderedDict((f, {}) for f in DUTY_FIELDS)
+    for d in duty_counts(start, end, field):
+        for f, n in d["fields"].items():
+            per_field.setdefault(f, {})[d["doctor"]] = n
+    result = []
+    for f, counts in per_field.items():
+        if not counts:
+            continue
+        values = list(counts.values())
+        mean = sum(values) / len(values)
+        stdev = (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5
+        most = max(counts.items(), key=lambda kv: (kv[1], kv[0]))
+        least = min(counts.items(), key=lambda kv: (kv[1], kv[0]))
+        result.append({
+            "field": f, "doctors": len(values), "total": sum(values),
+            "mean": round(mean, 2), "stdev": round(stdev, 2), "cv": round(stdev / mean, 3),
+            "max": {"doctor": most[0], "count": most[1]},
+            "min": {"doctor": least[0], "count": least[1]},
+        })
+    return result
+
+
 # ── Claude による予定表解析 ──────────────────────────────
 PARSE_SCHEMA = {
     "type": "object",
@@ -200,34 +1485,144 @@ PARSE_PROMPT = """あなたは整形外科医局の週間予定表から当番
 - 医師名以外の情報(患者に関する情報など)があっても絶対に出力に含めない
 - 該当欄が空欄の場合は "未設定" とする
 - weekday には表の曜日列に書かれている曜日をそのまま出力する
-- 日付はYYYY-MM-DD形式。年が表に書かれていない場合は、今日({today})に
-  最も近い将来または現在の週になるよう補完する
+- 日付はYYYY-MM-DD形式。年が表に書かれていない場合は、メッセージの最後に
+  示す今日の日付に最も近い将来または現在の週になるよう補完する
 - 表に載っている全日付(通常7日分)を出力する"""
 
 
-def _claude_parse(content_block):
-    """content_block(document または text)をClaudeに渡して days のリストを得る"""
+PARSE_MODEL = "claude-opus-4-8"
+
+
+def _parse_prompt():
+    """共通のプロンプトに、診療科ごとの追記(表の書き方の違いなど)を足したもの"""
+    extra = current_tenant()["prompt"]
+    return PARSE_PROMPT + ("\n\nこの診療科の表について:\n" + extra if extra else "")
+
+
+# 解析はストリーミングで受け取り、days 配列の1日分が閉じるたびに検証する。
+# おかしな値が出た時点で打ち切り、全体にも制限時間を設ける
+# (以前は応答が返らないと取り込みスレッドが止まったままになった)。
+PARSE_DEADLINE = int(os.getenv("PARSE_DEADLINE", "150"))   # 秒
+_parse_metrics = collections.deque(maxlen=20)   # 直近の解析の所要時間・トークン数(/api/status用)
+_parse_totals = collections.Counter()            # 起動以降のトークン数の合計
+_parse_metrics_lock = threading.Lock()   # 取り込みスレッドから同時に更新される
+# プロンプトは毎回同じ内容なので system に置いてキャッシュ対象にし、
+# 毎回変わる予定表本体と今日の日付はメッセージの末尾に回す
+# (Claudeのプロンプトキャッシュは先頭からの一致部分にだけ効く)。
+_USAGE_FIELDS = ("input_tokens", "output_tokens",
+                 "cache_read_input_tokens", "cache_creation_input_tokens")
+
+
+class _DayObjectScanner:
+    """ストリームで届くJSON文字列から、days 配列の要素(深さ2のオブジェクト)を
+    閉じた順に取り出す"""
+
+    def __init__(self):
+        self.buf, self.pos, self.depth = [], 0, 0
+        self.in_str = self.escaped = False
+        self.start = None
+
+    def feed(self, text):
+        found = []
+        for ch in text:
+            self.buf.append(ch)
+            if self.in_str:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch == "{":
+                self.depth += 1
+                if self.depth == 2:
+                    self.start = len(self.buf) - 1
+            elif ch == "}":
+                if self.depth == 2 and self.start is not None:
+                    found.append(json.loads("".join(self.buf[self.start:])))
+                    self.start = None
+                self.depth -= 1
+        return found
+
+
+def _usage_counts(usage):
+    counts = {f: getattr(usage, f, None) or 0 for f in _USAGE_FIELDS}
+    details = getattr(usage, "output_tokens_details", None)
+    counts["thinking_tokens"] = getattr(details, "thinking_tokens", None) or 0
+    return counts
+
+
+def _claude_parse(content_block, timings=None, tokens=None):
+    """content_block(document または text)をClaudeに渡して days のリストを得る。
+    timings(dict)を渡すと ttft(最初の応答まで)・model(全体)の秒数を、
+    tokens(dict)を渡すと入力・出力・キャッシュ読み込み・思考のトークン数を書き込む。"""
     import anthropic
-    client = anthropic.Anthropic()
-    response = client.messages.create(
-        model="claude-opus-4-8",
+    client = anthropic.Anthropic(timeout=PARSE_DEADLINE, max_retries=0)
+    started = time.monotonic()
+    ttft = None
+    scanner = _DayObjectScanner()
+    with observe("anthropic", "messages", (anthropic.APIError,)), client.messages.stream(
+        model=PARSE_MODEL,
         max_tokens=8000,
         thinking={"type": "adaptive"},
         output_config={"format": {"type": "json_schema", "schema": PARSE_SCHEMA}},
+        system=[{"type": "text", "text": _parse_prompt(), "cache_control": {"type": "ephemeral"}}],
         messages=[{
             "role": "user",
             "content": [
                 content_block,
-                {"type": "text", "text": PARSE_PROMPT.format(today=now_jst().date().isoformat())},
+                {"type": "text", "text": "今日の日付: %s" % now_jst().date().isoformat()},
             ],
         }],
-    )
+    ) as stream:
+        # 応答が途切れたまま戻らない場合に備え、期限で接続を切る
+        watchdog = threading.Timer(PARSE_DEADLINE, stream.close)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            for event in stream:
+                if ttft is None and event.type in ("text", "thinking"):
+                    ttft = time.monotonic() - started
+                if event.type == "text":
+                    for day in scanner.feed(event.text):
+                        _check_day(day)   # 1日分ずつ検証し、不正なら即打ち切る
+            response = stream.get_final_message()
+        except Exception:
+            if time.monotonic() - started >= PARSE_DEADLINE:
+                raise TimeoutError("AI解析が%d秒以内に終わりませんでした" % PARSE_DEADLINE)
+            raise
+        finally:
+            watchdog.cancel()
+    total = time.monotonic() - started
+    counts = _usage_counts(response.usage)
+    with _parse_metrics_lock:
+        _parse_totals.update(counts)
+        _parse_totals["calls"] += 1
+        _parse_metrics.append(dict(
+            counts, at=now_jst().strftime("%Y-%m-%d %H:%M"), model=PARSE_MODEL,
+            ttft=round(ttft, 2) if ttft is not None else None, total=round(total, 2),
+        ))
+    if timings is not None:
+        timings["ttft"] = round(ttft or 0, 2)
+        timings["model"] = round(total, 2)
+    if tokens is not None:
+        tokens.update(counts)
     if response.stop_reason == "refusal":
         raise ValueError("AIが解析を拒否しました")
     text = next(b.text for b in response.content if b.type == "text")
     return json.loads(text)["days"]
 
 
+def parse_metrics():
+    with _parse_metrics_lock:
+        recent, tokens = list(_parse_metrics), dict(_parse_totals)
+    totals = sorted(t["total"] for t in recent)
+    return {"recent": recent[::-1][:5], "tokens": tokens,
+            "median_total": totals[len(totals) // 2] if totals else None}
+
+
 def _corrected_dates(days):
     """年の自動補正。
     予定表には年が書かれていないためAIが年を誤ることがある。
@@ -268,40 +1663,48 @@ def _clean_name(v):
     - 前後の空白と末尾の処置名(PRP等)を除く
     - 「◯◯宿直」は「◯◯(宿直)」に整形する"""
     v = re.sub(r"(PRP|ＰＲＰ)$", "", str(v).strip()).strip()
-    v = re.sub(r"^(.+?)[\((]?宿直[\))]?$", r"\1(宿直)", v)
+    v = re.sub(r"^(.+?)[\(（]?宿直[\)）]?$", r"\1(宿直)", v)
     return v or "未設定"
 
 
+def _convert_day(d):
+    """1日分の抽出結果を検証し、保存形式の assignment に変換する"""
+    values = [_clean_name(d.get(k, "")) for k in
+              ("kyukyu", "am_innai", "pm_innai", "am_iren", "pm_iren",
+               "zanban_1st", "zanban_2nd")]
+    for v in values:
+        # 防御: 医師名として異常な値(長文・改行=患者情報などの混入疑い)は破棄
+        if len(v) > 25 or "\n" in v:
+            raise ValueError("医師名として不正な値を検出: %s…" % v[:10])
+    gaikin = [str(g).strip() for g in (d.get("gaikin") or [])][:15]
+    for g in gaikin:
+        if len(g) > 30 or "\n" in g:
+            raise ValueError("外勤として不正な値を検出: %s…" % g[:10])
+    return {
+        "救急":  values[0], "AM院内": values[1], "PM院内": values[2],
+        "AM医連": values[3], "PM医連": values[4],
+        "残り番": [values[5], values[6]],
+        "外勤": [g for g in gaikin if g],
+    }
+
+
+def _check_day(d):
+    """ストリーム途中の1日分の検証(年の補正は全日付が揃ってから行う)"""
+    if not DATE_RE.match(str(d.get("date", ""))):
+        raise ValueError("日付の形式が不正です: %s" % d.get("date"))
+    _convert_day(d)
+
+
 def _validate_and_convert(days):
     """抽出結果を検証し、保存形式 {date: assignment} に変換する"""
     if not days or len(days) > 14:
         raise ValueError("抽出された日数が不正です(%d日)" % len(days or []))
     dates = _corrected_dates(days)
-    result = {}
-    for date, d in zip(dates, days):
-        values = [_clean_name(d.get(k, "")) for k in
-                  ("kyukyu", "am_innai", "pm_innai", "am_iren", "pm_iren",
-                   "zanban_1st", "zanban_2nd")]
-        for v in values:
-            # 防御: 医師名として異常な値(長文・改行=患者情報などの混入疑い)は破棄
-            if len(v) > 25 or "\n" in v:
-                raise ValueError("医師名として不正な値を検出: %s…" % v[:10])
-        gaikin = [str(g).strip() for g in (d.get("gaikin") or [])][:15]
-        for g in gaikin:
-            if len(g) > 30 or "\n" in g:
-                raise ValueError("外勤として不正な値を検出: %s…" % g[:10])
-        result[date] = {
-            "救急":  values[0], "AM院内": values[1], "PM院内": values[2],
-            "AM医連": values[3], "PM医連": values[4],
-            "残り番": [values[5], values[6]],
-            "外勤": [g for g in gaikin if g],
-        }
-    return result
+    return {date: _convert_day(d) for date, d in zip(dates, days)}
 
 
-def parse_pdf(pdf_bytes):
-    """PDFバイト列 → {date: assignment}"""
-    block = {
+def _pdf_block(pdf_bytes):
+    return {
         "type": "document",
         "source": {
             "type": "base64",
@@ -309,13 +1712,254 @@ def parse_pdf(pdf_bytes):
             "data": base64.standard_b64encode(pdf_bytes).decode("ascii"),
         },
     }
-    return _validate_and_convert(_claude_parse(block))
+
+
+def _text_block(text):
+    return {"type": "text", "text": "以下は予定表のテキストです:\n\n" + text}
+
+
+def parse_pdf(pdf_bytes, job=None, force=False):
+    """PDFバイト列 → {date: assignment}。文字情報からの直接読み取り → 解析キャッシュ →
+    AI解析 の順に試し、AIの結果はキャッシュに保存する。
+    jobを渡すと工程ごとの所要時間・使った経路(engine)・トークン数を書き込む。
+    force=True なら直接読み取りもキャッシュも使わずAIで読み直す(ダッシュボードの「再解析」)"""
+    job = job if job is not None else {"timings": {}}
+    job["cache_key"] = key = parse_cache_key(pdf_bytes)
+    job["cached"] = False
+    if not force:
+        with _job_step(job, "extract"):
+            days = _local_parse(pdf_bytes)
+        if days is not None:
+            job["engine"] = "local"
+            return days
+        days = parse_cache_get(key)
+        if days is not None:
+            job["engine"], job["cached"] = "cache", True
+            return days
+    job["engine"] = "claude"
+    with _job_step(job, "parse"):
+        raw = _claude_parse(_pdf_block(pdf_bytes), job["timings"], job.setdefault("tokens", {}))
+    with _job_step(job, "validate"):
+        days = _validate_and_convert(raw)
+    parse_cache_put(key, days)
+    return days
 
 
 def parse_text(text):
     """手動貼り付けテキスト → {date: assignment}(パース経路をPDFと統一)"""
-    block = {"type": "text", "text": "以下は予定表のテキストです:\n\n" + text}
-    return _validate_and_convert(_claude_parse(block))
+    return _validate_and_convert(_claude_parse(_text_block(text)))
+
+
+# ── PDFの文字情報からの直接抽出 ──────────────────────────
+# 週間予定PDFの多くは文字情報(テキストレイヤー)付きの表なので、
+# まず pdfplumber で表を読み、見出しから列を対応づけて PARSE_SCHEMA と同じ形に
+# する。結果は同じ _validate_and_convert() で検証し、確信度が低いときだけ
+# AI解析に回す(AIだと1件30〜60秒かかり、費用も発生する)。
+LOCAL_PARSE_MIN_CONFIDENCE = 0.85
+LOCAL_EXTRACTOR_VERSION = 1   # 抽出処理を直したら上げる(解析キャッシュの鍵に入る)
+_LOCAL_COLUMNS = [   # (見出しに含まれる語, 抽出先の項目)。上から順に照合する
+    ("救急", "kyukyu"), ("AM院内", "am_innai"), ("PM院内", "pm_innai"),
+    ("AM外来", "am_gairai"), ("PM外来", "pm_gairai"),
+    ("残り番", "zanban"), ("外勤", "gaikin"), ("曜", "weekday"), ("日付", "date"),
+]
+_LOCAL_REQUIRED = ("kyukyu", "am_innai", "pm_innai", "zanban")
+_MD_RE = re.compile(r"(\d{1,2})\s*[/月]\s*(\d{1,2})")
+_IREN_RE = re.compile(r"[((]\s*医連\s*[-\u2010-\u2015\u2212\u30fc\uff70]\s*([^))]+?)\s*[))]")
+
+
+def _norm_cell(v):
+    return unicodedata.normalize("NFKC", v or "").strip()
+
+
+def _header_key(cell):
+    h = re.sub(r"[\s::]", "", _norm_cell(cell))
+    for word, key in _LOCAL_COLUMNS:
+        if word in h:
+            return key
+    return None
+
+
+def _nearest_date(month, day, today):
+    """年の書かれていない月日を、今日に最も近い年の日付にする"""
+    candidates = []
+    for y in (today.year - 1, today.year, today.year + 1):
+        try:
+            candidates.append(datetime.date(y, month, day))
+        except ValueError:
+            continue   # 2/29など
+    return min(candidates, key=lambda c: abs((c - today).days)) if candidates else None
+
+
+def _cell_lines(text, key):
+    return [l.strip() for l in text.get(key, "").splitlines() if l.strip()]
+
+
+def _cell_iren(text, key):
+    """外来列の (医連-◯◯) 表記から医師名を取り出す"""
+    return (_IREN_RE.findall(text.get(key, "")) or ["未設定"])[0]
+
+
+def _local_row(cells, cols, today):
+    """表の1行 → PARSE_SCHEMA と同じ形の dict(日付が読めない行はNone)"""
+    text = {k: _norm_cell(cells[i]) if i < len(cells) else "" for k, i in cols.items()}
+    head = " ".join(_norm_cell(c) for c in cells[:2])   # 日付・曜日の列名がない表向け
+    m = _MD_RE.search(text.get("date") or head)
+    date = _nearest_date(int(m.group(1)), int(m.group(2)), today) if m else None
+    if date is None:
+        return None
+    if "weekday" in cols:
+        wd = re.search(r"[月火水木金土日]", text["weekday"])
+    else:
+        wd = re.search(r"[((]([月火水木金土日])[))]", text.get("date") or head)
+    zanban = [l for l in _cell_lines(text, "zanban") if not l.upper().startswith("PM")]
+    zanban += ["未設定", "未設定"]
+    return {
+        "date": date.isoformat(), "weekday": wd.group(wd.lastindex or 0) if wd else "",
+        "kyukyu": (_cell_lines(text, "kyukyu") or ["未設定"])[0],
+        "am_innai": (_cell_lines(text, "am_innai") or ["未設定"])[0],
+        "pm_innai": (_cell_lines(text, "pm_innai") or ["未設定"])[0],
+        "am_iren": _cell_iren(text, "am_gairai"), "pm_iren": _cell_iren(text, "pm_gairai"),
+        "zanban_1st": zanban[0], "zanban_2nd": zanban[1],
+        "gaikin": _cell_lines(text, "gaikin"),
+    }
+
+
+def extract_pdf_table(pdf_bytes):
+    """PDFの表から days のリストを抽出する。(days, 確信度0〜1) を返す。
+    pdfplumber が無い・表が見つからない場合は (None, 0)"""
+    try:
+        import pdfplumber
+    except ImportError:
+        return None, 0.0
+    today = now_jst().date()
+    days, cols = [], None
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        for page in pdf.pages:
+            for table in page.extract_tables():
+                for cells in table:
+                    keys = [_header_key(c) for c in cells]
+                    if "kyukyu" in keys and "zanban" in keys:
+                        cols = {}
+                        for i, k in enumerate(keys):
+                            if k and k not in cols:
+                                cols[k] = i
+                        continue
+                    if cols:
+                        row = _local_row(cells, cols, today)
+                        if row:
+                            days.append(row)
+    if not cols or any(k not in cols for k in _LOCAL_REQUIRED) or not 5 <= len(days) <= 14:
+        return None, 0.0
+    # 表の曜日と暦が合っている割合を確信度とする(年の補正は後段で行う)
+    matched = sum(1 for d in days
+                  if WEEKDAY_JA[datetime.date.fromisoformat(d["date"]).weekday()] == d["weekday"])
+    return days, matched / len(days)
+
+
+# ── PDF解析結果のキャッシュ ──────────────────────────────
+# 同じ週のPDFがgroup AとBの両方に転送されたり、訂正のため再投稿されたりすると、
+# 毎回AI解析(30〜60秒・有料)が走っていた。PDFのSHA-256とプロンプト・スキーマの
+# 版で鍵を作り、検証済みの {date: assignment} を parse_cache シートに保存する。
+# プロンプトやスキーマ・文字情報からの抽出処理を変えれば鍵が変わるので、
+# 古い結果は自然に使われなくなる。
+# 診療科ごとのプロンプト追記も版に含め、キャッシュは診療科のシートごとに持つ。
+# シートは全ワーカーで共有するので追記だけで更新する(プロセス内の写しを書き戻すと、
+# 別ワーカーが足したばかりの行を消してしまう)。削除は「鍵 | 日時 | 空」の行、
+# 全消去は鍵が "*" の行を足して表し、読むときに上から順に当てはめる。
+# 期限切れ・上限超過・削除済みの行は毎週の後始末で先頭からまとめて消す。
+PARSE_CACHE_MAX  = int(os.getenv("PARSE_CACHE_MAX", "30"))    # 件
+PARSE_CACHE_DAYS = int(os.getenv("PARSE_CACHE_DAYS", "30"))   # 日
+PARSE_VERSION = hashlib.sha256(json.dumps(
+    [PARSE_MODEL, PARSE_PROMPT, PARSE_SCHEMA,
+     LOCAL_EXTRACTOR_VERSION, _LOCAL_COLUMNS, LOCAL_PARSE_MIN_CONFIDENCE],
+    ensure_ascii=False, sort_keys=True,
+).encode("utf-8")).hexdigest()[:12]
+_parse_cache = _TenantState(lambda: {"size": None})   # 最後に読んだときの件数
+_parse_cache_stats = _TenantState(lambda: {"hit": 0, "miss": 0})
+
+
+def _parse_version():
+    extra = current_tenant()["prompt"]
+    if not extra:
+        return PARSE_VERSION
+    return hashlib.sha256((PARSE_VERSION + extra).encode("utf-8")).hexdigest()[:12]
+
+
+def parse_cache_key(pdf_bytes):
+    return "%s:%s" % (hashlib.sha256(pdf_bytes).hexdigest(), _parse_version())
+
+
+def _parse_cache_scan():
+    """parse_cache シートを読み、(行, {key: (行番号, saved_at, days)}(古い順)) を返す"""
+    rows = _worksheet("parse_cache", cols="3").get_all_values()
+    cutoff = (now_jst() - datetime.timedelta(days=PARSE_CACHE_DAYS)).strftime("%Y-%m-%d %H:%M")
+    entries = collections.OrderedDict()
+    for i, r in enumerate(rows, start=1):
+        if not r or not r[0]:
+            continue
+        if r[0] == "*":
+            entries.clear()
+            continue
+        entries.pop(r[0], None)
+        if len(r) >= 3 and r[2] and r[1] >= cutoff:
+            try:
+                entries[r[0]] = (i, r[1], json.loads(r[2]))
+            except ValueError:
+                continue
+    while len(entries) > PARSE_CACHE_MAX:
+        entries.popitem(last=False)
+    _parse_cache["size"] = len(entries)
+    return rows, entries
+
+
+def parse_cache_get(key):
+    try:
+        hit = _parse_cache_scan()[1].get(key)
+    except Exception as e:
+        sys.stderr.write("解析キャッシュ読み込みエラー: %s\n" % e)
+        _forget_worksheets()
+        hit = None
+    _parse_cache_stats["hit" if hit else "miss"] += 1
+    return dict(hit[2]) if hit else None
+
+
+def _append_parse_cache(key, days_json):
+    _worksheet("parse_cache", cols="3").append_row(
+        [key, now_jst().strftime("%Y-%m-%d %H:%M"), days_json], value_input_option="RAW")
+
+
+def parse_cache_put(key, days):
+    try:
+        _append_parse_cache(key, json.dumps(days, ensure_ascii=False))
+    except Exception as e:
+        # キャッシュに書けなくても取り込み自体は続ける
+        sys.stderr.write("解析キャッシュ書き込みエラー: %s\n" % e)
+        _forget_worksheets()
+
+
+def parse_cache_clear(key=None):
+    """key指定でその1件、省略で全件を消す。消した件数を返す"""
+    entries = _parse_cache_scan()[1]
+    n = len(entries) if key is None else int(key in entries)
+    if n:
+        _append_parse_cache(key or "*", "")
+        _parse_cache["size"] = len(entries) - n
+    return n
+
+
+def compact_parse_cache():
+    """使われなくなった先頭の行を消す(毎週の後始末)。消した行数を返す。
+    末尾には他のワーカーが追記していても、先頭の行番号は変わらない"""
+    rows, entries = _parse_cache_scan()
+    first_live = min([i for i, _, _ in entries.values()] or [len(rows) + 1])
+    k = first_live - 1
+    if k:
+        _worksheet("parse_cache", cols="3").delete_rows(1, k)
+    return k
+
+
+def parse_cache_stats():
+    return dict(_parse_cache_stats, size=_parse_cache["size"], version=_parse_version())
 
 
 # ── メッセージ整形 ───────────────────────────────────────
@@ -324,52 +1968,494 @@ def format_date_ja(date_str):
     return "%d/%d(%s)" % (d.month, d.day, WEEKDAY_JA[d.weekday()])
 
 
+def _uses(*fields):
+    """今の診療科がこれらの担当欄のどれかを使っているか"""
+    return any(f in current_tenant()["fields"] for f in fields)
+
+
 def create_reminder(assignment):
+    """本日の担当(診療科が使っていない担当欄の行は出さない)"""
+    fields = current_tenant()["fields"]
+    v = lambda k: assignment.get(k, "未設定") if k in fields else "−"
     first, second = (assignment.get("残り番") or ["未設定", "未設定"])[:2]
-    return (
-        "【本日の担当者】\n\n"
-        "救急(リハ診)：%s\n"
-        "院内：AM %s → PM %s\n"
-        "医連：AM %s → PM %s\n"
-        "残り番：1st %s ／ 2nd %s\n\n"
-        "よろしくお願いします！"
-        % (assignment.get("救急", "未設定"),
-           assignment.get("AM院内", "未設定"), assignment.get("PM院内", "未設定"),
-           assignment.get("AM医連", "未設定"), assignment.get("PM医連", "未設定"),
-           first, second)
-    )
+    lines = ["【本日の担当者】\n"]
+    if _uses("救急"):
+        lines.append("救急(リハ診)：%s" % v("救急"))
+    if _uses("AM院内", "PM院内"):
+        lines.append("院内：AM %s → PM %s" % (v("AM院内"), v("PM院内")))
+    if _uses("AM医連", "PM医連"):
+        lines.append("医連：AM %s → PM %s" % (v("AM医連"), v("PM医連")))
+    lines.append("残り番：1st %s ／ 2nd %s\n" % (first, second))
+    lines.append("よろしくお願いします！")
+    return "\n".join(lines)
 
 
 def create_summary(days):
     """取込結果の確認用サマリ(group Bに投稿)"""
+    fields = current_tenant()["fields"]
+    v = lambda a, k: a.get(k) if k in fields else "−"
     lines = ["【予定表を取り込みました】\n以下の内容で毎朝配信します。誤りがあれば修正してください。\n"]
     for date in sorted(days):
         a = days[date]
         z = (a.get("残り番") or ["未設定", "未設定"])[:2]
-        lines.append(
-            "%s\n 救急:%s 院内:%s→%s\n 医連:%s→%s 残り番:%s/%s"
-            % (format_date_ja(date), a.get("救急"), a.get("AM院内"), a.get("PM院内"),
-               a.get("AM医連"), a.get("PM医連"), z[0], z[1])
-        )
+        first, second = [], []
+        if _uses("救急"):
+            first.append("救急:%s" % v(a, "救急"))
+        if _uses("AM院内", "PM院内"):
+            first.append("院内:%s→%s" % (v(a, "AM院内"), v(a, "PM院内")))
+        if _uses("AM医連", "PM医連"):
+            second.append("医連:%s→%s" % (v(a, "AM医連"), v(a, "PM医連")))
+        second.append("残り番:%s/%s" % (z[0], z[1]))
+        lines.append("\n".join([format_date_ja(date)] +
+                               [" " + " ".join(part) for part in (first, second) if part]))
     return "\n".join(lines)
 
 
+# ── 配信(LINEへの送信) ─────────────────────────────────
+# 送信はすべて _send() を通し、
+# (1) トークンバケットで毎秒の送信数を抑える(全診療科で共有。LINEの上限はチャネル単位)
+# (2) 429・5xx・通信エラーは Retry-After(なければ指数バックオフ)に従って再送する
+# (3) 再送しても二重に届かないよう、同じ X-Line-Retry-Key を付ける
+#     (LINE側で受付済みなら409が返るので、送信済みとして扱う)
+# 毎朝のリマインドは deliver() で宛先ごとに送り、結果を配信台帳
+# (deliveries シート/ローカルDBの deliveries 表)に残す。送れなかった宛先だけを
+# 次の実行・ダッシュボードの「配信」で送り直す。全宛先に届いたら従来どおり
+# scheduleシートB1にも配信済み日付を書く(台帳を読めないときの判定用)。
+LINE_TIMEOUT      = float(os.getenv("LINE_TIMEOUT", "10"))   # 秒
+DELIVERY_RATE     = float(os.getenv("DELIVERY_RATE", "10"))  # 回/秒
+DELIVERY_ATTEMPTS = 4
+DELIVERY_KEEP_DAYS = 31
+MULTICAST_MAX = 500   # multicast 1回あたりの宛先数の上限(個人宛てのみ)
+RETRY_KEY_NS = uuid.UUID("5b8f0c8e-2f57-4a0e-9a51-3c1d2b7e6a10")
+
+
+class _TokenBucket:
+    """毎秒rate個まで(最大burst個まで貯められる)の送信許可を出す"""
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = burst, time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_send_bucket = _TokenBucket(DELIVERY_RATE, max(1, int(DELIVERY_RATE)))
+
+
+def _retry_after(e, attempt):
+    """再送までの待ち秒数(Retry-Afterがあればそれに従う)"""
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return min(60.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return min(30.0, 2 ** attempt + random.random())
+
+
+def _send(call, retry_key, op="push"):
+    """call(retry_key) を送信する。429・5xx・通信エラーは同じ再送キーで再送する"""
+    for attempt in range(DELIVERY_ATTEMPTS):
+        _send_bucket.take()
+        try:
+            with observe("line", op):
+                call(retry_key)
+            return
+        except LineBotApiError as e:
+            if e.status_code == 409 and retry_key:
+                return   # 同じ再送キーで受付済み
+            if e.status_code != 429 and e.status_code < 500 or attempt == DELIVERY_ATTEMPTS - 1:
+                raise
+            wait = _retry_after(e, attempt)
+        except OSError as e:   # requestsの通信エラー・タイムアウトもここ
+            if attempt == DELIVERY_ATTEMPTS - 1:
+                raise
+            wait = _retry_after(e, attempt)
+        record_retry("line", op)
+        sys.stderr.write("LINE送信を再試行(%d回目・%.1f秒後)\n" % (attempt + 1, wait))
+        time.sleep(wait)
+
+
+def _send_error(e):
+    if isinstance(e, LineBotApiError):
+        return "HTTP %s %s" % (e.status_code, getattr(e.error, "message", "") or "")
+    return str(e) or e.__class__.__name__
+
+
 def push(group_id, text):
-    line_bot_api.push_message(group_id, TextSendMessage(text=text))
+    message = TextSendMessage(text=text)
+    _send(lambda key: line_bot_api.push_message(
+        group_id, message, retry_key=key, timeout=LINE_TIMEOUT), str(uuid.uuid4()))
+
+
+def _retry_key(kind, date, target):
+    """同じ日・同じ宛先への配信は何度送り直しても同じキーになる"""
+    return str(uuid.uuid5(RETRY_KEY_NS, "%s:%s:%s:%s" % (current_tenant()["id"], kind, date, target)))
+
+
+def _ledger_sent(kind, date):
+    """配信台帳で、この日すでに届いている宛先の集合"""
+    db = _local_store()
+    if db is not None:
+        rows = db.execute("SELECT target FROM deliveries WHERE date = ? AND kind = ? AND status = 'sent'",
+                          (date, kind))
+        return {r[0] for r in rows}
+    rows = _worksheet("deliveries", cols="6").get_all_values()
+    return {r[2] for r in rows if len(r) >= 4 and r[0] == date and r[1] == kind and r[3] == "sent"}
+
+
+def _ledger_record(kind, date, results, keys):
+    at = now_jst().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [[date, kind, target, status, at, keys[target]]
+            for target, status in results.items() if status != "skipped"]
+    if not rows:
+        return
+    db = _local_store()
+    if db is not None:
+        db.executemany("INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?, ?, ?)",
+                       [tuple(r) for r in rows])
+    # ほかのdynoからも見えるよう、Sheetsへは同期で書く
+    _sheet_write_retry(lambda: _worksheet("deliveries", cols="6").append_rows(
+        rows, value_input_option="RAW"), "配信台帳")
+
+
+def deliver(kind, date, text, targets):
+    """textをtargetsへ送る。台帳で送信済みの宛先は飛ばす。
+    {宛先: "sent" / "skipped" / "failed: 理由"} を返す。"""
+    try:
+        done = _ledger_sent(kind, date)
+    except Exception as e:
+        sys.stderr.write("配信台帳読み込みエラー: %s\n" % e)
+        _forget_worksheets()
+        done = set()   # 読めなければ全員に送る(再送キーで二重送信は防げる)
+    targets = [t for t in targets if t]
+    results = {t: "skipped" for t in targets if t in done}
+    keys = {t: _retry_key(kind, date, t) for t in targets}
+    pending = [t for t in targets if t not in done]
+    message = TextSendMessage(text=text)
+    users = [t for t in pending if t.startswith("U")]
+    batches = [users[i:i + MULTICAST_MAX] for i in range(0, len(users), MULTICAST_MAX)]
+    if len(users) == 1:
+        batches = []   # 1人なら push で足りる
+    for batch in batches:
+        key = _retry_key(kind, date, ",".join(batch))
+        keys.update({t: key for t in batch})
+        try:
+            _send(lambda k: line_bot_api.multicast(batch, message, retry_key=k, timeout=LINE_TIMEOUT),
+                  key, "multicast")
+            results.update({t: "sent" for t in batch})
+        except Exception as e:
+            results.update({t: "failed: %s" % _send_error(e) for t in batch})
+    for target in pending:
+        if target in results:
+            continue
+        try:
+            _send(lambda k: line_bot_api.push_message(
+                target, message, retry_key=k, timeout=LINE_TIMEOUT), keys[target])
+            results[target] = "sent"
+        except Exception as e:
+            results[target] = "failed: %s" % _send_error(e)
+    _ledger_record(kind, date, results, keys)
+    return results
+
+
+def prune_delivery_ledger():
+    """DELIVERY_KEEP_DAYS日より前の台帳の行を消す(行は日付順に追記されている)"""
+    cutoff = (now_jst().date() - datetime.timedelta(days=DELIVERY_KEEP_DAYS)).isoformat()
+    db = _db()
+    if db is not None:
+        db.execute("DELETE FROM deliveries WHERE date < ?", (cutoff,))
+    ws = _worksheet("deliveries", cols="6")
+    k = 0
+    for r in ws.col_values(1):
+        if r >= cutoff:
+            break
+        k += 1
+    if k:
+        ws.delete_rows(1, k)
+    return k
+
+
+def deliver_reminder(today, assignment):
+    """本日の担当を全宛先へ配信する。全員に届けば配信済みを記録してTrue"""
+    results = deliver("daily", today, create_reminder(assignment), current_tenant()["targets"])
+    failed = {t: r for t, r in results.items() if r.startswith("failed")}
+    if failed:
+        log_event("エラー", "本日(%s)の配信に一部失敗(%d/%d件): %s" % (
+            today, len(failed), len(results), "; ".join("%s %s" % kv for kv in failed.items())[:200]))
+        return False
+    mark_delivered(today)
+    return True
+
+
+# ── 取り込みジョブ ───────────────────────────────────────
+# PDF・テキストの取り込みは固定数のワーカーで順に処理する。
+# PDFがまとめて転送されてもAI解析が同時に何本も走らないようにし、
+# 待ち行列が一杯なら受け付けずにグループへ「混雑中」と返す。
+# ジョブごとの状態と工程別の所要時間は /api/jobs で確認できる。
+# 同時実行数・待ち行列の上限はプロセス(gunicornのワーカー)ごと。
+# ジョブの記録はワーカー共有のSQLite(_worker_db)にも書き、どのワーカーからも見えるようにする。
+#
+# AI解析は最大 PARSE_DEADLINE 秒かかり、終了時の猶予(SHUTDOWN_TIMEOUT。Herokuは
+# SIGTERMから30秒で強制終了)には収まらない。そこで受け付けた取り込みの種類と引数を
+# jobs_pending シートに「ID | 日時 | 内容のJSON」で書いておき、終わったら
+# 「ID | 日時 | 空」の行を足して消し込む(追記だけ。解析キャッシュと同じ形)。
+# 消し込まれないまま残ったものは、次の起動で resume_jobs() がやり直す。
+# 同じ起動(BOT_BOOT_ID)のワーカーが受け付けた分は実行中なので対象にしない。
+# ワーカーはロックファイルで1つずつ確認する(web dynoが1台の前提)。
+INGEST_WORKERS   = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "6"))   # 実行中+待ちの上限
+JOBS_KEPT = 30
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))   # SIGTERMから強制終了までの猶予より短く
+JOB_RESUME_MAX_AGE = 24 * 3600   # 秒。これより古い中断はやり直さない
+JOB_RESUME_LOCK_PATH = os.getenv("JOB_RESUME_LOCK_PATH", "/tmp/toyosu-bot-resume.lock")
+_ingest_pool  = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_ingest_slots = threading.BoundedSemaphore(INGEST_QUEUE_MAX)
+# jobs_pending への追記は1本のスレッドで順に行う(Webhookの応答をSheetsの待ち時間で
+# 遅らせないため。受け付けと消し込みの順序もこれで保たれる)
+_intent_pool  = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-intent")
+_jobs = collections.OrderedDict()
+_jobs_lock = threading.Lock()
+_shutdown = {"closing": False}
+
+
+def _store_job(job):
+    """ジョブの状態をワーカー共有のDBへ書き、ダッシュボードへ知らせる(状態が変わったときだけ呼ぶ)"""
+    publish("job", {"id": job["id"], "status": job["status"]})
+    try:
+        db = _worker_db()
+        if db is None:
+            return
+        db.execute("INSERT OR REPLACE INTO jobs (id, created, data) VALUES (?, ?, ?)",
+                   (job["id"], job["seq"], json.dumps(job, ensure_ascii=False)))
+        if random.random() < 0.1:
+            db.execute("DELETE FROM jobs WHERE id NOT IN "
+                       "(SELECT id FROM jobs ORDER BY created DESC LIMIT ?)", (JOBS_KEPT,))
+    except sqlite3.Error as e:
+        sys.stderr.write("ジョブ記録エラー: %s\n" % e)
+
+
+def submit_job(kind, label, fn, *args):
+    """取り込みジョブを待ち行列に入れる。満杯ならNoneを返す。
+    fn(job, *args) は工程ごとに _job_step() で所要時間を記録する。"""
+    if _shutdown["closing"] or not _ingest_slots.acquire(blocking=False):
+        return None
+    job = {
+        "id": uuid.uuid4().hex[:8], "kind": kind, "label": label,
+        "status": "queued", "created": now_jst().strftime("%Y-%m-%d %H:%M:%S"),
+        "seq": time.time(), "pid": os.getpid(), "tenant": current_tenant()["id"],
+        "timings": {}, "error": None, "trace": current_trace(),
+    }
+    with _jobs_lock:
+        _jobs[job["id"]] = job
+        while len(_jobs) > JOBS_KEPT:
+            _jobs.popitem(last=False)
+    _store_job(job)
+    _queue_job_intent(job["id"], {"kind": kind, "label": label, "args": list(args), "boot": BOOT_ID})
+
+    def run():
+        job["status"] = "running"
+        _store_job(job)
+        started = time.monotonic()
+        try:
+            fn(job, *args)
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["timings"]["total"] = round(time.monotonic() - started, 2)
+            _store_job(job)
+            _queue_job_intent(job["id"], None)   # 失敗も消し込む(グループへは通知済み)
+            _ingest_slots.release()
+            _flush_metrics(force=True)
+
+    try:
+        _ingest_pool.submit(contextvars.copy_context().run, run)
+    except RuntimeError:   # 終了処理中
+        _ingest_slots.release()
+        with _jobs_lock:
+            _jobs.pop(job["id"], None)
+        _queue_job_intent(job["id"], None)
+        return None
+    return job
+
+
+def _queue_job_intent(job_id, intent):
+    """_record_job_intent を追記用のスレッドに任せる"""
+    try:
+        _intent_pool.submit(contextvars.copy_context().run, _record_job_intent, job_id, intent)
+    except RuntimeError:   # 終了処理の最後。受け付けはもう無い
+        _record_job_intent(job_id, intent)
 
 
-# ── 取り込み共通処理 ─────────────────────────────────────
-def ingest(days, source):
-    save_schedule(days)
-    log_event("成功", "%sから%d日分を取り込み" % (source, len(days)))
-    push(GROUP_ID_B, create_summary(days))
+def _record_job_intent(job_id, intent):
+    """jobs_pending シートへ受け付け(intent)または消し込み(None)を追記する"""
+    try:
+        _worksheet("jobs_pending", cols="3").append_row(
+            [job_id, now_jst().strftime("%Y-%m-%d %H:%M:%S"),
+             json.dumps(intent, ensure_ascii=False) if intent else ""],
+            value_input_option="RAW")
+    except Exception as e:
+        # 書けなくても取り込みは続ける(中断されたときにやり直せないだけ)
+        sys.stderr.write("取り込みの受付記録エラー: %s\n" % e)
+        _forget_worksheets()
+
+
+def _pending_job_intents():
+    """(行, {ID: (行番号, 日時, 内容)}(受け付けた順)) を返す。消し込み済みは除く"""
+    rows = _worksheet("jobs_pending", cols="3").get_all_values()
+    pending = collections.OrderedDict()
+    for i, r in enumerate(rows, start=1):
+        if not r or not r[0]:
+            continue
+        pending.pop(r[0], None)
+        if len(r) >= 3 and r[2]:
+            try:
+                pending[r[0]] = (i, r[1], json.loads(r[2]))
+            except ValueError:
+                continue
+    return rows, pending
+
+
+def _resume_tenant_jobs():
+    runners = {"pdf": _ingest_pdf_job, "text": _ingest_text_job}
+    cutoff = (now_jst() - datetime.timedelta(seconds=JOB_RESUME_MAX_AGE)).strftime("%Y-%m-%d %H:%M:%S")
+    _, pending = _pending_job_intents()
+    n = 0
+    for job_id, (_, created, intent) in pending.items():
+        if BOOT_ID and intent.get("boot") == BOOT_ID:
+            continue   # この起動のワーカーが実行中
+        if created >= cutoff and intent.get("kind") in runners:
+            job = submit_job(intent["kind"], intent["label"], runners[intent["kind"]], *intent["args"])
+            if job is None:
+                break   # 待ち行列が一杯。残りは次の起動で
+            n += 1
+            log_event("確認", "中断された取り込みをやり直します: %s" % intent["label"])
+        _record_job_intent(job_id, None)
+    # 消し込み済みの先頭の行を片付ける(末尾に追記されていても先頭の行番号は変わらない)
+    rows, pending = _pending_job_intents()
+    k = min([i for i, _, _ in pending.values()] or [len(rows) + 1]) - 1
+    if k:
+        _worksheet("jobs_pending", cols="3").delete_rows(1, k)
+    return n
+
+
+def resume_jobs():
+    """前回の起動で終わらなかった取り込みを全診療科でやり直す。やり直した件数を返す"""
+    n = 0
+    with _file_lock(JOB_RESUME_LOCK_PATH):
+        for tenant in TENANTS.values():
+            with use_tenant(tenant):
+                try:
+                    n += _resume_tenant_jobs()
+                except Exception as e:
+                    sys.stderr.write("中断された取り込みの確認エラー(%s): %s\n" % (tenant["id"], e))
+                    _forget_worksheets()
+    return n
+
+
+def resume_jobs_async():
+    threading.Thread(target=resume_jobs, name="resume-jobs", daemon=True).start()
+
+
+@contextlib.contextmanager
+def _job_step(job, name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        job["timings"][name] = round(time.monotonic() - started, 2)
+
+
+def _job_timing_text(job):
+    text = " ".join("%s %.1fs" % (k, v) for k, v in job["timings"].items())
+    t = job.get("tokens")
+    if t:
+        text += " / tokens in %d(cache %d) out %d(思考 %d)" % (
+            t["input_tokens"], t["cache_read_input_tokens"], t["output_tokens"], t["thinking_tokens"])
+    return text
+
+
+def list_jobs():
+    """今の診療科の直近のジョブ(新しい順)。ワーカー共有のDBがあれば全ワーカーの分を返す"""
+    tid = current_tenant()["id"]
+    with _jobs_lock:
+        jobs = {j["id"]: dict(j, timings=dict(j["timings"]), tokens=dict(j.get("tokens") or {}))
+                for j in _jobs.values() if j["tenant"] == tid}
+    try:
+        db = _worker_db()
+        rows = db.execute("SELECT data FROM jobs ORDER BY created DESC LIMIT ?",
+                          (JOBS_KEPT,)) if db is not None else []
+        for (data,) in rows:
+            j = json.loads(data)
+            jobs.setdefault(j["id"], j)   # 自プロセスのジョブは実行中の最新状態を使う
+    except sqlite3.Error as e:
+        sys.stderr.write("ジョブ読み込みエラー: %s\n" % e)
+    return sorted(jobs.values(), key=lambda j: j.get("seq", 0), reverse=True)[:JOBS_KEPT]
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job if job["tenant"] == current_tenant()["id"] else None
+    try:
+        db = _worker_db()
+        row = db and db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    except sqlite3.Error as e:
+        sys.stderr.write("ジョブ読み込みエラー: %s\n" % e)
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def shutdown(timeout=None):
+    """終了前の後始末。新しい取り込みを断り、実行中・待ち中の取り込み →
+    jobs_pending への追記 → Sheetsへの複製 → ログの書き込み の順に、合わせてtimeout秒まで待つ。
+    待ちきれなかった取り込みは jobs_pending に残り、次の起動でやり直す。
+    gunicornでは worker_exit から、開発サーバーでは atexit から呼ばれる。
+    全部終えられたらTrue"""
+    deadline = time.monotonic() + (SHUTDOWN_TIMEOUT if timeout is None else timeout)
+    _shutdown["closing"] = True
+    _scheduler["stop"].set()
+    done = True
+    for pool in (_ingest_pool, _intent_pool, _replica_pool):
+        t = threading.Thread(target=pool.shutdown, kwargs={"wait": True}, daemon=True)
+        t.start()
+        t.join(max(0, deadline - time.monotonic()))
+        done = done and not t.is_alive()
+    done = flush_logs(max(0, deadline - time.monotonic())) and done
+    _flush_metrics(force=True)
+    if not done:
+        sys.stderr.write("終了処理が時間内に終わりませんでした\n")
+    return done
+
+
+atexit.register(shutdown)
+
+
+def ingest(job, days, source):
+    with _job_step(job, "save"):
+        save_schedule(days)
+    with _job_step(job, "push"):
+        push(current_tenant()["group_b"], create_summary(days))
+    log_event("成功", "%sから%d日分を取り込み(%s)" % (source, len(days), _job_timing_text(job)))
 
 
 # ── 定期実行(cron-job.orgから) ──────────────────────────
-def _time_is_today(time_str, today):
-    """ログの日時文字列が今日かどうか。
+def _log_date(time_str):
+    """ログの日時文字列から YYYY-MM-DD を得る(読めなければNone)。
     Sheetsに表示形式を変えられている可能性があるため、
-    2026-07-16 / 2026/07/16 / 7/16/2026(米国式)のどれでも判定できるようにする。"""
+    2026-07-16 / 2026/07/16 / 7/16/2026(米国式)のどれでも読めるようにする。"""
     t = str(time_str).strip()
     m = re.match(r"^(\d{4})[-/](\d{1,2})[-/](\d{1,2})", t)          # 年/月/日
     if m:
@@ -377,17 +2463,25 @@ def _time_is_today(time_str, today):
     else:
         m = re.match(r"^(\d{1,2})[-/](\d{1,2})[-/](\d{4})", t)      # 月/日/年(米国式)
         if not m:
-            return False
+            return None
         mo, d, y = m.groups()
-    return "%04d-%02d-%02d" % (int(y), int(mo), int(d)) == today
+    return "%04d-%02d-%02d" % (int(y), int(mo), int(d))
 
 
-def delivered_today(logs=None):
+def _time_is_today(time_str, today):
+    """ログの日時文字列が今日かどうか"""
+    return _log_date(time_str) == today
+
+
+def delivered_today(logs=None, delivered=None):
     """今日すでに配信済みか。
     正式にはscheduleシートB1の配信済み日付で判定し、
-    保険としてログの「配信」記録の日時でも照合する。"""
+    保険としてログの「配信」記録の日時でも照合する。
+    load_trigger_snapshot() で読んだ値を渡せば追加の読み込みはしない。"""
     today = now_jst().date().isoformat()
-    if load_delivered_date() == today:
+    if delivered is None:
+        delivered = load_delivered_date()
+    if delivered == today:
         return True
     if logs is None:
         logs = load_logs()
@@ -397,25 +2491,35 @@ def delivered_today(logs=None):
     )
 
 
-def daily_reminder():
+def daily_reminder(scheduled=False):
+    """本日の担当を配信する(予定・配信済み日付・ログは1回の一括読み込みで)。
+    scheduled=True は内蔵スケジューラから。再起動後の取り戻しで同じ日に何度も呼ばれるので、
+    配信済みなら記録を残さずに終え、未登録の警告は台帳で1日1回にする"""
     today = now_jst().date().isoformat()
-    if delivered_today():
+    snapshot = load_trigger_snapshot()
+    if delivered_today(snapshot["logs"], snapshot["delivered"]):
         # ダッシュボードから手動配信済みの日は二重配信しない
-        log_event("確認", "本日(%s)は配信済みのため自動配信をスキップ" % today)
+        if not scheduled:
+            log_event("確認", "本日(%s)は配信済みのため自動配信をスキップ" % today)
         return
-    assignment = load_schedule().get(today)
+    assignment = snapshot["schedule"].get(today)
     if assignment:
-        push(GROUP_ID_A, create_reminder(assignment))
-        mark_delivered(today)
+        if not deliver_reminder(today, assignment):
+            raise RuntimeError("配信に失敗した宛先があります")
         log_event("配信", "本日(%s)の担当を配信" % today)
     else:
-        push(GROUP_ID_B, "⚠ 本日(%s)の予定が未登録のため、リマインドを配信できませんでした。\nPDFを投稿するか、テキストで登録してください。" % format_date_ja(today))
+        group_b = current_tenant()["group_b"]
+        if scheduled and _ledger_sent("daily-missing", today):
+            return   # 警告は送信済み(再起動前に送った)
+        push(group_b, "⚠ 本日(%s)の予定が未登録のため、リマインドを配信できませんでした。\nPDFを投稿するか、テキストで登録してください。" % format_date_ja(today))
         log_event("警告", "本日(%s)の予定が未登録" % today)
+        _ledger_record("daily-missing", today, {group_b: "sent"}, {group_b: ""})
 
 
-def weekly_check():
-    """日曜19:00: 来週分が未登録なら催促(全消去は廃止)"""
-    today = now_jst().date()
+def weekly_check(today=None):
+    """日曜19:00: 来週分が未登録なら催促(全消去は廃止)。
+    today は予定の実行日(遅れて日付をまたいでも、その回の日付で数える)"""
+    today = today or now_jst().date()
     next_monday = today + datetime.timedelta(days=(7 - today.weekday()))
     schedule = load_schedule()
     has_next_week = any(
@@ -423,15 +2527,340 @@ def weekly_check():
         for i in range(7)
     )
     if not has_next_week:
-        push(GROUP_ID_B, "【お知らせ】\n来週分の予定表がまだ取り込まれていません。\nPDFをこのグループに転送するか、テキストで登録してください。")
+        push(current_tenant()["group_b"], "【お知らせ】\n来週分の予定表がまだ取り込まれていません。\nPDFをこのグループに転送するか、テキストで登録してください。")
         log_event("警告", "来週分が未登録(日曜チェック)")
     else:
         log_event("確認", "来週分は登録済み(日曜チェック)")
+    # 実行済みの印(内蔵スケジューラが再起動後に二度実行しないため)
+    _ledger_record("weekly", today.isoformat(), {"check": "sent"}, {"check": ""})
+    for housekeeping in (rotate_logs, prune_delivery_ledger, compact_parse_cache):
+        try:
+            housekeeping()
+        except Exception as e:
+            sys.stderr.write("%s のエラー: %s\n" % (housekeeping.__name__, e))
+            _forget_worksheets()
+
+
+# 定期実行は全診療科へ並行に(最大 TENANT_PARALLEL 件ずつ)行う。
+# 1つの診療科で失敗しても、ほかの診療科の配信は止めない。
+TENANT_PARALLEL = int(os.getenv("TENANT_PARALLEL", "4"))
+_tenant_runs = {}   # "daily"/"weekly" → 直近の実行結果(/api/status用)
+
+
+def for_each_tenant(kind, fn):
+    """全診療科でfnを実行し、{id: {"ok", "seconds", "error"}} を返す"""
+    def one(tenant):
+        started = time.monotonic()
+        with use_tenant(tenant):
+            try:
+                fn()
+                result = {"ok": True}
+            except Exception as e:
+                sys.stderr.write("%s の処理に失敗(%s): %s\n" % (kind, tenant["id"], e))
+                result = {"ok": False, "error": str(e)}
+        result["seconds"] = round(time.monotonic() - started, 2)
+        return tenant["id"], result
+
+    workers = max(1, min(TENANT_PARALLEL, len(TENANTS)))
+    # トレースIDを引き継ぐため、呼び出し元の状態を診療科ごとに写して渡す
+    calls = [(contextvars.copy_context(), t) for t in TENANTS.values()]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tenant") as pool:
+        results = dict(pool.map(lambda c: c[0].run(one, c[1]), calls))
+    _tenant_runs[kind] = {"at": now_jst().strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    _flush_metrics(force=True)
+    return results
+
+
+def _run_report(title, results):
+    """cron-job.org向けの応答。1件でも失敗していれば500にして気づけるようにする"""
+    lines = [title] + [
+        "%s %s %.2fs%s" % (tid, "ok" if r["ok"] else "NG", r["seconds"],
+                          "" if r["ok"] else ": " + r["error"])
+        for tid, r in results.items()
+    ]
+    ok = all(r["ok"] for r in results.values())
+    return "\n".join(lines), 200 if ok else 500, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+# ── 事前ウォームアップ ───────────────────────────────────
+# 起動直後の最初の /trigger-daily は、anthropic・Google認証まわりのimport、
+# サービスアカウントの認証、スプレッドシートとワークシートを開く処理、予定の読み込みを
+# すべて待つことになり、朝の配信が数秒遅れていた。サーバーとして動くプロセスでは
+# これらを先に済ませておく:
+# - 起動時(gunicornの post_worker_init・開発サーバー起動時。WARMUP_ON_BOOT)
+# - / へのアクセス時(cron-job.orgの起こし用。応答は待たせずに裏で行う)
+# - 内蔵スケジューラの定期実行の WARMUP_LEAD 秒前
+# ツールやスクリプトから import したときは何もせず、重いimportも使うときまで遅らせる。
+# WARMUP_INTERVAL 秒以内に済ませていれば繰り返さない。所要時間は工程ごとに
+# プロセスで最初の1回だけログに残す(以降は標準エラーへ)。
+WARMUP_ON_BOOT  = os.getenv("WARMUP_ON_BOOT", "1") in ("1", "true", "yes")
+WARMUP_INTERVAL = int(os.getenv("WARMUP_INTERVAL", str(SCHEDULE_CACHE_TTL)))   # 秒
+WARMUP_LEAD     = 120   # 秒
+_warm = {"at": None, "runs": 0, "last": None}
+_warm_lock = threading.Lock()
+
+
+def _warm_imports(job):
+    with _job_step(job, "imports"):
+        import google.auth.transport.requests  # noqa: F401  Sheetsの認証
+        import anthropic  # noqa: F401  AI解析
+        try:
+            import pdfplumber  # noqa: F401  PDFの直接読み取り
+        except ImportError:
+            pass
+
+
+def _warm_tenant(job):
+    with _job_step(job, "auth"):
+        _spreadsheet()   # 認証とスプレッドシートを開く(アクセストークンもここで取る)
+    with _job_step(job, "worksheets"):
+        for name, cols in (("schedule", "10"), ("days", "2"), ("log", "10"), ("deliveries", "6")):
+            _worksheet(name, cols=cols)
+    with _job_step(job, "schedule"):
+        load_trigger_snapshot()   # 予定のキャッシュとログの行数も埋まる
+
+
+def warm_up(reason):
+    """importと全診療科の認証・ワークシート・予定の読み込みを済ませる。実行したらTrue。
+    定期実行の記録(_tenant_runs)には残さない"""
+    if not _warm_lock.acquire(blocking=False):
+        return False   # ほかのスレッドが実行中
+    token = new_trace("warm-")
+    try:
+        if _warm["at"] is not None and time.monotonic() - _warm["at"] < WARMUP_INTERVAL:
+            return False
+        started = time.monotonic()
+        common, per_tenant, errors = {"timings": {}}, {}, {}
+        try:
+            _warm_imports(common)
+        except ImportError as e:
+            sys.stderr.write("ウォームアップのimportエラー: %s\n" % e)
+        for tenant in TENANTS.values():
+            job = per_tenant[tenant["id"]] = {"timings": {}}
+            with use_tenant(tenant):
+                try:
+                    _warm_tenant(job)
+                except Exception as e:
+                    errors[tenant["id"]] = str(e)
+                    _forget_worksheets()
+        total = round(time.monotonic() - started, 2)
+        _warm.update(at=time.monotonic(), runs=_warm["runs"] + 1, last={
+            "reason": reason, "at": now_jst().strftime("%Y-%m-%d %H:%M:%S"), "seconds": total,
+            "imports": common["timings"].get("imports"),
+            "tenants": {tid: job["timings"] for tid, job in per_tenant.items()},
+            "ok": not errors,
+        })
+        for tid, job in per_tenant.items():
+            text = "起動準備(%s) %.1fs: %s" % (reason, total, " ".join(
+                "%s %.1fs" % kv for kv in list(common["timings"].items()) + list(job["timings"].items())))
+            if tid in errors:
+                text += " / 失敗: %s" % errors[tid]
+            if _warm["runs"] == 1:
+                with use_tenant(TENANTS[tid]):
+                    log_event("確認", text)
+            else:
+                sys.stderr.write("%s [%s]\n" % (text, tid))
+        return True
+    finally:
+        _trace_var.reset(token)
+        _warm_lock.release()
+
+
+def warm_up_async(reason):
+    """裏でウォームアップする(済んだばかりならスレッドも作らない)"""
+    if _warm["at"] is not None and time.monotonic() - _warm["at"] < WARMUP_INTERVAL:
+        return
+    threading.Thread(target=warm_up, args=(reason,), name="warm-up", daemon=True).start()
+
+
+def warm_stats():
+    return {"runs": _warm["runs"], "last": _warm["last"]}
+
+
+# ── 内蔵スケジューラ ─────────────────────────────────────
+# SCHEDULER_ENABLED=1 のとき、cron-job.org の代わりにプロセス内のスレッドが
+# DAILY_AT(毎日 "HH:MM")・WEEKLY_AT("sun 19:00")のJSTで定期実行する。
+# /trigger-daily・/trigger-weekly は手動実行用にそのまま残す。
+# - 予定時刻ちょうどまで待って実行する(途中で起きても時刻を計算し直して待ち直す)
+# - 再起動などで時刻を過ぎていたら、SCHEDULER_CATCHUP 秒以内なら遅れて実行する。
+#   二重実行は配信記録・配信台帳で防ぐ(配信済みの診療科は飛ばす。予定が未登録の
+#   警告も台帳に daily-missing として残し、再起動のたびに送り直さない)
+# - 失敗した診療科があれば SCHEDULER_RETRY 秒後に再実行する(届いた宛先は台帳で飛ばす)
+# - gunicornの複数ワーカーのうち、ロックファイルを取れた1つだけが実行する
+#   (そのワーカーが落ちれば、ほかのワーカーがロックを取って引き継ぐ)
+# - 予定時刻から何秒遅れて始まったかを記録する(/api/status の scheduler)
+# - 開始するのはgunicornのワーカー起動時(post_worker_init)と開発サーバーの __main__ だけ
+SCHEDULER_ENABLED   = os.getenv("SCHEDULER_ENABLED", "") in ("1", "true", "yes")
+DAILY_AT            = os.getenv("DAILY_AT", "07:00")
+WEEKLY_AT           = os.getenv("WEEKLY_AT", "sun 19:00")
+SCHEDULER_CATCHUP   = int(os.getenv("SCHEDULER_CATCHUP", "10800"))   # 秒
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "/tmp/toyosu-bot-scheduler.lock")
+SCHEDULER_RETRY     = 300   # 秒
+SCHEDULER_LOCK_RETRY = 30   # ロックを取れなかったワーカーが取り直すまでの秒数
+_WEEKDAY_EN = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+_scheduler = {"thread": None, "lock": None, "stop": threading.Event(),
+              "last": {}, "retry_at": {}, "runs": {}}
+
+
+def _parse_at(spec):
+    """ "07:00" → (None, 7, 0)、"sun 19:00" → (6, 19, 0)"""
+    parts = spec.lower().split()
+    weekday = _WEEKDAY_EN.index(parts[0][:3]) if len(parts) == 2 else None
+    hour, minute = (int(x) for x in parts[-1].split(":"))
+    return weekday, hour, minute
+
+
+def _last_due(spec, now):
+    """now以前で直近の予定時刻"""
+    weekday, hour, minute = spec
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if weekday is None:
+        return due if due <= now else due - datetime.timedelta(days=1)
+    due -= datetime.timedelta(days=(now.weekday() - weekday) % 7)
+    return due if due <= now else due - datetime.timedelta(days=7)
+
+
+def _next_due(spec, now):
+    return _last_due(spec, now) + datetime.timedelta(days=1 if spec[0] is None else 7)
+
+
+def _scheduled_daily():
+    daily_reminder(scheduled=True)   # 手動配信済み・再起動前に配信済みならここで終わる
+
+
+def _scheduled_weekly(due):
+    # 台帳はその回の予定日で見る(遅れて日付をまたいだ実行でも同じ回と分かるように)
+    if _ledger_sent("weekly", due.date().isoformat()):
+        return
+    weekly_check(due.date())
+
+
+def _scheduler_is_leader():
+    """ロックファイルを取れたらTrue(取れたロックはプロセスが終わるまで持ち続ける)"""
+    if _scheduler["lock"] is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:   # Windowsなど。1プロセスで動かす前提
+        _scheduler["lock"] = True
+        return True
+    f = open(SCHEDULER_LOCK_PATH, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _scheduler["lock"] = f
+    sys.stderr.write("内蔵スケジューラを開始(pid %d)\n" % os.getpid())
+    return True
+
+
+def _scheduler_fire(kind, fn, due):
+    """全診療科で fn(due) を実行する。全部成功すればTrue"""
+    started = now_jst()
+    late = (started - due).total_seconds()
+    token = new_trace("sched-")
+    try:
+        results = for_each_tenant(kind, lambda: fn(due))
+    finally:
+        _trace_var.reset(token)
+    ok = all(r["ok"] for r in results.values())
+    _scheduler["runs"][kind] = {
+        "due": due.strftime("%Y-%m-%d %H:%M:%S"), "started": started.strftime("%Y-%m-%d %H:%M:%S"),
+        "late_seconds": round(late, 3), "catch_up": late > 60, "ok": ok,
+    }
+    sys.stderr.write("定期実行 %s: 予定 %s から %.2f秒遅れで開始\n" % (kind, due.strftime("%H:%M"), late))
+    return ok
+
+
+def _scheduler_loop():
+    jobs = [("daily", _parse_at(DAILY_AT), lambda due: _scheduled_daily()),
+            ("weekly", _parse_at(WEEKLY_AT), _scheduled_weekly)]
+    stop = _scheduler["stop"]
+    while not stop.is_set():
+        if not _scheduler_is_leader():
+            stop.wait(SCHEDULER_LOCK_RETRY)
+            continue
+        now = now_jst()
+        last, retry_at = _scheduler["last"], _scheduler["retry_at"]
+        for kind, spec, fn in jobs:
+            due = _last_due(spec, now)
+            if last.get(kind) == due or now < retry_at.get(kind, now):
+                continue
+            if (now - due).total_seconds() > SCHEDULER_CATCHUP:
+                last[kind] = due   # 取り戻せる範囲を過ぎた回は実行しない
+                retry_at.pop(kind, None)
+                continue
+            try:
+                ok = _scheduler_fire(kind, fn, due)
+            except Exception as e:
+                sys.stderr.write("定期実行 %s のエラー: %s\n" % (kind, e))
+                ok = False
+            if ok:
+                last[kind] = due
+                retry_at.pop(kind, None)
+            else:
+                retry_at[kind] = now_jst() + datetime.timedelta(seconds=SCHEDULER_RETRY)
+        now = now_jst()
+        wake = min([_next_due(spec, now) for _, spec, _ in jobs] + list(retry_at.values()))
+        lead = wake - datetime.timedelta(seconds=WARMUP_LEAD)
+        if now < lead:   # 予定時刻の少し前に起きて、接続とキャッシュを温めておく
+            if stop.wait((lead - now).total_seconds()):
+                break
+            warm_up("定期実行前")
+            now = now_jst()
+        stop.wait(max(0.0, (wake - now).total_seconds()))
+
+
+def start_scheduler():
+    if not SCHEDULER_ENABLED or _scheduler["thread"] is not None:
+        return
+    t = threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True)
+    t.start()
+    _scheduler["thread"] = t
+
+
+def scheduler_stats():
+    return {"enabled": SCHEDULER_ENABLED, "leader": _scheduler["lock"] is not None,
+            "daily_at": DAILY_AT, "weekly_at": WEEKLY_AT, "runs": _scheduler["runs"]}
 
 
 # ── Flask エンドポイント ─────────────────────────────────
+@app.before_request
+def _select_tenant():
+    """管理画面・APIは ?tenant=<id> で診療科を選ぶ(省略時は最初の診療科)。
+    Webhookは各イベントのグループから診療科を決める。"""
+    tid = request.args.get("tenant")
+    if tid and tid not in TENANTS:
+        abort(404)
+    g.tenant_token = _tenant_var.set(TENANTS[tid] if tid else None)
+
+
+@app.before_request
+def _start_trace():
+    """リクエストごとのトレースID(HerokuのルーターのX-Request-Idがあれば合わせる)"""
+    rid = re.sub(r"[^0-9A-Za-z_-]", "", request.headers.get("X-Request-Id", ""))[:64]
+    g.trace_token = _trace_var.set(rid) if rid else new_trace()
+
+
+@app.after_request
+def _trace_header(res):
+    if current_trace():
+        res.headers["X-Request-Id"] = current_trace()
+    return res
+
+
+@app.teardown_request
+def _reset_request_context(exc=None):
+    for name, var in (("tenant_token", _tenant_var), ("trace_token", _trace_var)):
+        token = g.pop(name, None)
+        if token is not None:
+            var.reset(token)
+
+
 @app.route("/", methods=["GET"])
 def wakeup():
+    warm_up_async("wakeup")
     return "I'm awake!", 200
 
 
@@ -444,15 +2873,13 @@ def _check_token(expected):
 @app.route("/trigger-daily", methods=["GET"])
 def trigger_daily():
     _check_token(TRIGGER_TOKEN)
-    daily_reminder()
-    return "Daily reminder processed", 200
+    return _run_report("Daily reminder processed", for_each_tenant("daily", daily_reminder))
 
 
 @app.route("/trigger-weekly", methods=["GET"])
 def trigger_weekly():
     _check_token(TRIGGER_TOKEN)
-    weekly_check()
-    return "Weekly check processed", 200
+    return _run_report("Weekly check processed", for_each_tenant("weekly", weekly_check))
 
 
 @app.route("/callback", methods=["POST"])
@@ -471,35 +2898,125 @@ def callback():
 # タイムアウト→再送→再解析の無限ループになるため、
 # (1) 応答は即返し、解析は別スレッドで行う
 # (2) 処理済みメッセージIDを記憶し、再送されても二度目は解析しない
-_processed_ids = set()
+# 以前は500件を超えたら全消去していたため、消した直後の再送が再解析されていた。
+# 記録した順に並べて古いものから捨てる(上限件数+有効期限)ようにし、ワーカー共有の
+# SQLite(_worker_db)にも記録する。再送が別ワーカーに届いても、ワーカーの再起動直後
+# (再起動直後こそ再送が多い)でも二度目は解析しない。
+DEDUPE_MAX = 5000
+DEDUPE_TTL = 24 * 3600   # 秒。LINEの再送はこれより十分短い
+_dedupe_lock = threading.Lock()
+_dedupe = collections.OrderedDict()   # message_id → 記録時刻(古い順)
+_dedupe_stats = {"hit": 0, "miss": 0}
+
+
+def _dedupe_seen_in_db(message_id, now):
+    """SQLiteに記録済み(期限内)ならTrue。未記録なら記録してFalse"""
+    db = _worker_db()
+    if db is None:
+        return False
+    # 別ワーカーが同じ期限切れIDを同時に「初見」と判定しないよう、読んで書くまでを1つにする
+    with _db_transaction(db):
+        if db.execute("INSERT OR IGNORE INTO processed (id, seen) VALUES (?, ?)",
+                      (message_id, now)).rowcount:
+            if random.random() < 0.01:   # たまに期限切れを掃除する
+                db.execute("DELETE FROM processed WHERE seen < ?", (now - DEDUPE_TTL,))
+            return False
+        row = db.execute("SELECT seen FROM processed WHERE id = ?", (message_id,)).fetchone()
+        if row and now - row[0] < DEDUPE_TTL:
+            return True
+        db.execute("UPDATE processed SET seen = ? WHERE id = ?", (now, message_id))
+        return False
 
 
 def _mark_processed(message_id):
-    """このメッセージが初見なら記憶してTrue、処理済みならFalse"""
-    if message_id in _processed_ids:
-        return False
-    if len(_processed_ids) > 500:
-        _processed_ids.clear()
-    _processed_ids.add(message_id)
-    return True
+    """このメッセージが初見なら記憶してTrue、処理済みならFalse。
+    _dedupe は記録した順(=期限切れの順)に並べておき、先頭から期限切れを捨てる。
+    再送を見つけても記録時刻も順番も変えない(最初の受信から DEDUPE_TTL で忘れる)。"""
+    now = time.time()
+    with _dedupe_lock:
+        while _dedupe and now - next(iter(_dedupe.values())) >= DEDUPE_TTL:
+            _dedupe.popitem(last=False)
+        seen = message_id in _dedupe
+    if not seen:
+        # DBの確認はロックの外で(接続を開くのを待たせない)。同じIDを同時に確かめても、
+        # DBのトランザクションで初見になるのは1つだけ
+        try:
+            seen = _dedupe_seen_in_db(message_id, now)
+        except sqlite3.Error as e:
+            sys.stderr.write("処理済みID記録エラー: %s\n" % e)
+    with _dedupe_lock:
+        if seen or message_id in _dedupe:
+            _dedupe_stats["hit"] += 1
+            return False
+        _dedupe_stats["miss"] += 1
+        _dedupe[message_id] = now
+        while len(_dedupe) > DEDUPE_MAX:
+            _dedupe.popitem(last=False)
+        return True
+
+
+def _forget_processed(message_id):
+    """受け付けられなかったメッセージを、再投稿・再送で処理できるように忘れる"""
+    with _dedupe_lock:
+        _dedupe.pop(message_id, None)
+        try:
+            db = _worker_db()
+            if db is not None:
+                db.execute("DELETE FROM processed WHERE id = ?", (message_id,))
+        except sqlite3.Error as e:
+            sys.stderr.write("処理済みID削除エラー: %s\n" % e)
+
+
+def dedupe_stats():
+    total = _dedupe_stats["hit"] + _dedupe_stats["miss"]
+    return dict(_dedupe_stats, size=len(_dedupe), durable=bool(LOCAL_DB_PATH or WORKER_DB_PATH),
+                hit_rate=round(_dedupe_stats["hit"] / total, 3) if total else None)
 
 
 def _source_group(event):
     return event.source.group_id if event.source.type == "group" else None
 
 
-def _ingest_pdf_async(message_id, file_name):
+def _ingest_pdf_job(job, message_id, file_name, force=False):
+    """force=True ならAIで読み直す(ダッシュボードの「再解析」)"""
+    job["message_id"] = message_id
     try:
-        content = line_bot_api.get_message_content(message_id)
-        days = parse_pdf(content.content)
-        ingest(days, "PDF(%s)" % file_name)
+        with _job_step(job, "download"):
+            with observe("line", "content"):
+                content = line_bot_api.get_message_content(message_id).content
+        days = parse_pdf(content, job, force)
+        note = {"cache": "・解析済みの結果を再利用", "local": "・文字情報から直接読み取り"}
+        ingest(job, days, "PDF(%s)%s" % (file_name, note.get(job["engine"], "")))
     except Exception as e:
         sys.stderr.write("PDF取り込みエラー: %s\n" % e)
         log_event("エラー", "PDF取り込み失敗: %s" % e)
         try:
-            push(GROUP_ID_B, "⚠ PDF(%s)の読み取りに失敗しました。\nテキストでの手動登録をお願いします。\n(理由: %s)" % (file_name, e))
+            push(current_tenant()["group_b"], "⚠ PDF(%s)の読み取りに失敗しました。\nテキストでの手動登録をお願いします。\n(理由: %s)" % (file_name, e))
         except Exception:
             pass
+        raise
+
+
+def _local_parse(pdf_bytes):
+    """文字情報から読めて検証も通れば {date: assignment}、だめならNone(AI解析へ)"""
+    try:
+        raw, confidence = extract_pdf_table(pdf_bytes)
+        if raw is None or confidence < LOCAL_PARSE_MIN_CONFIDENCE:
+            return None
+        return _validate_and_convert(raw)
+    except Exception as e:
+        sys.stderr.write("PDFの直接読み取りに失敗(AI解析へ切り替え): %s\n" % e)
+        return None
+
+
+def _reply_busy(event):
+    """取り込みの待ち行列が一杯のときの返信(再投稿してもらう)"""
+    try:
+        with observe("line", "reply"):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(
+                text="⏳ 現在ほかの予定表を処理中で混み合っています。\n少し時間をおいてからもう一度投稿してください。"))
+    except Exception as e:
+        sys.stderr.write("混雑返信エラー: %s\n" % e)
 
 
 @handler.add(MessageEvent, message=FileMessage)
@@ -507,18 +3024,20 @@ def handle_file(event):
     group = _source_group(event)
     if group:
         sys.stderr.write("Group ID = %s\n" % group)
-    if group not in (GROUP_ID_A, GROUP_ID_B):
+    tenant = tenant_for_group(group)
+    if tenant is None:
         return
     name = (event.message.file_name or "").lower()
     if not name.endswith(".pdf"):
         return
-    if not _mark_processed(event.message.id):
-        return  # 再送された同じPDFは無視
-    threading.Thread(
-        target=_ingest_pdf_async,
-        args=(event.message.id, event.message.file_name),
-        daemon=True,
-    ).start()
+    with use_tenant(tenant):
+        if not _mark_processed(event.message.id):
+            return  # 再送された同じPDFは無視
+        job = submit_job("pdf", event.message.file_name, _ingest_pdf_job,
+                         event.message.id, event.message.file_name)
+        if job is None:
+            _forget_processed(event.message.id)   # 再投稿されたら受け付ける
+            _reply_busy(event)
 
 
 @handler.add(MessageEvent, message=TextMessage)
@@ -526,55 +3045,222 @@ def handle_text(event):
     group = _source_group(event)
     if group:
         sys.stderr.write("Group ID = %s\n" % group)
-    text = event.message.text
+    tenant = tenant_for_group(group)
+    if tenant is None:
+        if len(TENANTS) > 1:
+            return   # どの診療科か分からない
+        tenant = current_tenant()
+    with use_tenant(tenant):
+        _handle_text(event, group, event.message.text)
+
 
+def _handle_text(event, group, text):
     if "今週の予定を確認" in text:
         schedule = load_schedule()
         today = now_jst().date().isoformat()
         upcoming = {d: a for d, a in schedule.items() if d >= today}
         msg = create_summary(upcoming) if upcoming else "登録済みの予定がありません。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        with observe("line", "reply"):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
         return
 
     # 手動登録: group Bで「救急」「残り番」を含むテキストを予定表とみなす
     # (AI解析に時間がかかるため、応答は即返して解析は別スレッドで行う)
-    if group == GROUP_ID_B and "救急" in text and "残り番" in text:
+    if group == current_tenant()["group_b"] and "救急" in text and "残り番" in text:
         if not _mark_processed(event.message.id):
             return
-        threading.Thread(target=_ingest_text_async, args=(text,), daemon=True).start()
+        if submit_job("text", "テキスト", _ingest_text_job, text) is None:
+            _forget_processed(event.message.id)
+            _reply_busy(event)
 
 
-def _ingest_text_async(text):
+def _ingest_text_job(job, text):
     try:
-        days = parse_text(text)
-        save_schedule(days)
-        log_event("成功", "テキストから%d日分を登録" % len(days))
-        push(GROUP_ID_B, "✅ %d日分の予定を登録しました。\n「今週の予定を確認」で内容を確認できます。" % len(days))
+        with _job_step(job, "parse"):
+            raw = _claude_parse(_text_block(text), job["timings"], job.setdefault("tokens", {}))
+        with _job_step(job, "validate"):
+            days = _validate_and_convert(raw)
+        with _job_step(job, "save"):
+            save_schedule(days)
+        with _job_step(job, "push"):
+            push(current_tenant()["group_b"], "✅ %d日分の予定を登録しました。\n「今週の予定を確認」で内容を確認できます。" % len(days))
+        log_event("成功", "テキストから%d日分を登録(%s)" % (len(days), _job_timing_text(job)))
     except Exception as e:
         log_event("エラー", "テキスト登録失敗: %s" % e)
         try:
-            push(GROUP_ID_B, "⚠ テキストの読み取りに失敗しました。(理由: %s)" % e)
+            push(current_tenant()["group_b"], "⚠ テキストの読み取りに失敗しました。(理由: %s)" % e)
         except Exception:
             pass
+        raise
 
 
 # ── 管理ダッシュボード ───────────────────────────────────
+# ダッシュボードは1分ごとに /api/status と /api/schedule を取りに来る。
+# 予定のリビジョン・ログ番号・配信済み日付から作ったETagを返し、
+# 変化がなければ(If-None-Matchが一致すれば)304で本文を返さない。
+# 版の確認はプロセス内のキャッシュとローカルDBだけで行い、Sheetsには
+# 予定キャッシュのTTLが切れたときのB1:C1の確認でしか触れない。
 @app.route("/admin", methods=["GET"])
 def admin():
     _check_token(ADMIN_TOKEN)
     return render_template("admin.html")
 
 
+def _schedule_version():
+    db = _local_store()
+    if db is not None:
+        return (_meta_get(db, "local_rev"), _meta_get(db, "reconciled_at"), _meta_get(db, "delivered"))
+    load_schedule()   # TTL内ならキャッシュのまま
+    c = _schedule_cache
+    return (c["rev"], c["gen"], c["delivered"])
+
+
+def _conditional_json(version, build):
+    """versionから作ったETagがIf-None-Matchと一致すれば304、違えばbuild()の結果を返す"""
+    etag = hashlib.sha1(repr(version).encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        res = app.response_class(status=304)
+    else:
+        res = jsonify(build())
+    res.set_etag(etag)
+    res.headers["Cache-Control"] = "private, no-cache"
+    return res
+
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
+    """since=ログ番号 を付けると、それより後のログだけを返す(logs_reset=Trueなら全件)"""
+    _check_token(ADMIN_TOKEN)
+    since = request.args.get("since", type=int)
+    today = now_jst().date().isoformat()
+    version = _schedule_version()
+    seq = log_seq()   # Sheetsでも行数の確認はTTLに1回なので、304ならシートを読まない
+
+    def build():
+        if _local_store() is None:
+            # 末尾を1回だけ読み、差分も配信済みの判定もそこから出す
+            tail = load_logs()
+            logs, cur, reset = _logs_since(tail, _log_state["base"] + (_log_state["rows"] or 0), since)
+        else:
+            logs, cur, reset = load_logs_since(since)
+            tail = logs if reset else None   # 差分だけでは今日の配信記録を取りこぼす
+        delivered = version[-1] or ""
+        return {
+            "now": now_jst().strftime("%Y-%m-%d %H:%M"),
+            "today": today,
+            "delivered_today": delivered_today(tail, delivered),
+            "logs": logs,
+            "log_seq": cur,
+            "logs_reset": reset,
+            "schedule_cache": schedule_cache_stats(),
+            "parse_cache": parse_cache_stats(),
+            "dedupe": dedupe_stats(),
+            "parse": parse_metrics(),
+            "tenant": current_tenant()["id"],
+            "tenants": [{"id": t["id"], "name": t["name"]} for t in TENANTS.values()],
+            "tenant_runs": _tenant_runs,
+            "scheduler": scheduler_stats(),
+            "warm_up": warm_stats(),
+        }
+    return _conditional_json(("status", today, seq) + version, build)
+
+
+# 変更通知のストリーム。接続1本がWebサーバーのスレッドを1本使い続けるので、
+# プロセスごとの同時接続数を絞り、一定時間で切って張り直してもらう
+# (EventSourceは自動で再接続する)。上限を超えたら503を返し、ページは定期取得で動く。
+# 別ワーカーでの変更はこのプロセスに通知が来ないため、ローカルDB使用時は
+# 待ち時間ごとにログ番号と予定のリビジョンを見比べて知らせる。
+# Sheetsだけのときは見比べる手段がないので、hello で cross_worker=false を伝え、
+# ページは定期取得の間隔を延ばさない。
+EVENT_SUBSCRIBERS_MAX = int(os.getenv("EVENT_SUBSCRIBERS_MAX", "4"))
+EVENT_STREAM_SECONDS = 300
+EVENT_KEEPALIVE = 15   # Herokuのルーターは55秒無通信で切るため
+
+
+def _sse(kind, data):
+    return "event: %s\ndata: %s\n\n" % (kind, json.dumps(data, ensure_ascii=False))
+
+
+@app.route("/api/events", methods=["GET"])
+def api_events():
+    _check_token(ADMIN_TOKEN)
+    q = subscribe(EVENT_SUBSCRIBERS_MAX)
+    if q is None:
+        return jsonify({"error": "接続数が上限です"}), 503
+
+    tenant = current_tenant()
+
+    def watermark():
+        with use_tenant(tenant):
+            db = _db()
+            if db is None:
+                return None
+            return (log_seq(), _meta_get(db, "local_rev"), _meta_get(db, "delivered"))
+
+    def stream():
+        try:
+            seen = watermark()
+            yield "retry: 5000\n" + _sse("hello", {"pid": os.getpid(), "cross_worker": seen is not None})
+            end = time.monotonic() + EVENT_STREAM_SECONDS
+            while time.monotonic() < end:
+                try:
+                    kind, data = q.get(timeout=EVENT_KEEPALIVE)
+                    yield _sse(kind, data)
+                    seen = watermark()
+                except queue.Empty:
+                    mark = watermark()
+                    if mark != seen:
+                        seen = mark
+                        yield _sse("changed", {})
+                    else:
+                        yield ": keepalive\n\n"
+        finally:
+            unsubscribe(q)
+
+    return app.response_class(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/metrics", methods=["GET"])
+def api_metrics():
+    """依存先ごとの p50/p95・呼び出し数・失敗数・再試行数(管理画面用)"""
+    _check_token(ADMIN_TOKEN)
+    return jsonify({"dependencies": dependency_stats(), "pid": os.getpid()})
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheusの収集用(?token=ADMIN_TOKEN か X-Trigger-Token ヘッダー)"""
+    _check_token(ADMIN_TOKEN)
+    return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route("/api/jobs", methods=["GET"])
+def api_jobs():
+    _check_token(ADMIN_TOKEN)
+    return jsonify({"jobs": list_jobs(), "workers": INGEST_WORKERS, "queue_max": INGEST_QUEUE_MAX})
+
+
+@app.route("/api/jobs/<job_id>/reparse", methods=["POST"])
+def api_job_reparse(job_id):
+    """PDFの取り込みジョブを、解析キャッシュを捨ててAIで読み直す"""
+    _check_token(ADMIN_TOKEN)
+    old = get_job(job_id)
+    if not old or old["kind"] != "pdf" or not old.get("message_id"):
+        return jsonify({"error": "再解析できるPDFのジョブが見つかりません"}), 404
+    if old.get("cache_key"):
+        parse_cache_clear(old["cache_key"])
+    job = submit_job("pdf", old["label"], _ingest_pdf_job, old["message_id"], old["label"], True)
+    if job is None:
+        return jsonify({"error": "混み合っています。少し待ってから再度お試しください"}), 503
+    return jsonify({"ok": True, "job": job["id"]})
+
+
+@app.route("/api/parse-cache/clear", methods=["POST"])
+def api_parse_cache_clear():
     _check_token(ADMIN_TOKEN)
-    logs = load_logs()
-    return jsonify({
-        "now": now_jst().strftime("%Y-%m-%d %H:%M"),
-        "today": now_jst().date().isoformat(),
-        "delivered_today": delivered_today(logs),
-        "logs": logs,
-    })
+    n = parse_cache_clear()
+    return jsonify({"ok": True, "cleared": n, "parse_cache": parse_cache_stats()})
 
 
 @app.route("/api/deliver", methods=["POST"])
@@ -582,19 +3268,67 @@ def api_deliver():
     """ダッシュボードの「未配信」タップから、本日の担当を今すぐ配信する"""
     _check_token(ADMIN_TOKEN)
     today = now_jst().date().isoformat()
-    assignment = load_schedule().get(today)
+    assignment = load_trigger_snapshot()["schedule"].get(today)
     if not assignment:
         return jsonify({"error": "本日の予定が未登録のため配信できません"}), 400
-    push(GROUP_ID_A, create_reminder(assignment))
-    mark_delivered(today)
+    if not deliver_reminder(today, assignment):
+        return jsonify({"error": "配信に失敗した宛先があります(ログを確認してください)"}), 502
     log_event("配信", "本日(%s)の担当を配信(ダッシュボードから手動)" % today)
     return jsonify({"ok": True})
 
 
+def _archive_range():
+    """?from=&to=(省略時は直近 ARCHIVE_RANGE_DAYS 日)。不正ならNone"""
+    today = now_jst().date()
+    start = request.args.get("from") or (today - datetime.timedelta(days=ARCHIVE_RANGE_DAYS)).isoformat()
+    end = request.args.get("to") or today.isoformat()
+    if not (DATE_RE.match(start) and DATE_RE.match(end)) or start > end:
+        return None
+    return start, end
+
+
+def _archive_query(build):
+    rng = _archive_range()
+    if rng is None:
+        return jsonify({"error": "日付の形式が不正です"}), 400
+    try:
+        return jsonify(dict(archive_coverage(*rng), **build(*rng)))
+    except Exception as e:   # 索引を作り直すためのシートが読めないなど
+        sys.stderr.write("履歴の集計エラー: %s\n" % e)
+        _forget_worksheets()
+        return jsonify({"error": "履歴を読み込めませんでした"}), 502
+
+
+@app.route("/api/archive/duties", methods=["GET"])
+def api_archive_duties():
+    """医師ごと・担当欄ごとの担当回数。?from=&to=&field=&doctor="""
+    _check_token(ADMIN_TOKEN)
+    field, doctor = request.args.get("field"), request.args.get("doctor")
+    return _archive_query(lambda start, end: {
+        "doctors": duty_counts(start, end, field, doctor)})
+
+
+@app.route("/api/archive/fairness", methods=["GET"])
+def api_archive_fairness():
+    """担当欄ごとの回数の偏り。?from=&to=&field="""
+    _check_token(ADMIN_TOKEN)
+    field = request.args.get("field")
+    return _archive_query(lambda start, end: {
+        "fields": duty_fairness(start, end, field)})
+
+
 @app.route("/api/schedule", methods=["GET"])
 def api_schedule_get():
     _check_token(ADMIN_TOKEN)
-    return jsonify(load_schedule())
+    return _conditional_json(("schedule",) + _schedule_version()[:2], load_schedule)
+
+
+@app.route("/api/schedule/refresh", methods=["POST"])
+def api_schedule_refresh():
+    """スプレッドシートを直接編集したときなどに、キャッシュを捨てて読み直す"""
+    _check_token(ADMIN_TOKEN)
+    schedule = load_schedule(force=True)
+    return jsonify({"ok": True, "days": len(schedule), "schedule_cache": schedule_cache_stats()})
 
 
 @app.route("/api/schedule", methods=["POST"])
@@ -615,5 +3349,12 @@ def api_schedule_post():
 
 
 if __name__ == "__main__":
+    # 開発サーバー用。SIGTERMでもatexit(shutdown)が走るように通常終了させる
+    # (本番は gunicorn main:app -c gunicorn.conf.py)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if WARMUP_ON_BOOT:
+        warm_up_async("boot")
+    resume_jobs_async()
+    start_scheduler()
     port = int(os.getenv("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
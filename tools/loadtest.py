@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+/callback Webhookの負荷試験。LINE・Google Sheets・Anthropic を
+プロセス内の偽物に差し替え、署名付きのイベントを同時に送り込んで
+Webhookの応答時間(p50/p99)・スレッド数・メモリの増え方を測る。
+外部には一切接続しない。
+
+    python tools/loadtest.py                          # 全シナリオ
+    python tools/loadtest.py --scenario pdf --events 40 --concurrency 8
+    python tools/loadtest.py --sheets-latency 0.3 --model-latency 0.05
+
+シナリオ:
+    text        「今週の予定を確認」と予定表テキストの連投
+    pdf         PDFの連続転送(取り込みジョブが詰まったときの「混雑中」返信も見る)
+    redelivery  同じメッセージの再送(2回目以降は解析されないこと)
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+CHANNEL_SECRET = "loadtest-secret"
+GROUP_A, GROUP_B = "Cloadtest-group-a", "Cloadtest-group-b"
+os.environ.update({
+    "LINE_CHANNEL_SECRET": CHANNEL_SECRET, "LINE_CHANNEL_ACCESS_TOKEN": "loadtest",
+    "GROUP_ID_A": GROUP_A, "GROUP_ID_B": GROUP_B, "SPREADSHEET_ID": "loadtest",
+    # 処理済みID・ジョブのDBは実行ごとに新しくする(前回の実行の記録を拾わないように)
+    "WORKER_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "worker.sqlite3"),
+})
+
+import main  # noqa: E402
+import parse_bench  # noqa: E402  記録済み応答の再生クライアントを使い回す
+
+
+# ── 偽のGoogle Sheets ────────────────────────────────────
+def _a1(cell):
+    m = re.match(r"([A-Z]+)(\d*)", cell)
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - 64
+    return (int(m.group(2)) if m.group(2) else None), col
+
+
+class FakeWorksheet:
+    """main.py が使うメソッドだけを持つ、メモリ上のワークシート"""
+
+    def __init__(self, book, title):
+        self.book, self.title, self.id = book, title, len(book.sheets) + 1
+        self.rows = []
+
+    def _call(self):
+        self.book.call()
+
+    def _set(self, r, c, v):
+        while len(self.rows) < r:
+            self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = v
+
+    def _cell(self, r, c):
+        try:
+            return self.rows[r - 1][c - 1]
+        except IndexError:
+            return ""
+
+    def read(self, rng):
+        start, _, end = rng.partition(":")
+        r1, c1 = _a1(start)
+        r2, c2 = _a1(end or start)
+        r1, r2 = r1 or 1, r2 or (len(self.rows) if end else r1)
+        out = [[self._cell(r, c) for c in range(c1, c2 + 1)] for r in range(r1, r2 + 1)]
+        while out and not any(out[-1]):
+            out.pop()
+        return out
+
+    def write(self, rng, values):
+        r, c = _a1(rng.split(":")[0])
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self._set(r + i, c + j, v)
+
+    def acell(self, cell):
+        self._call()
+        r, c = _a1(cell)
+        return types.SimpleNamespace(value=self._cell(r, c) or None)
+
+    def get(self, rng, **kwargs):
+        self._call()
+        return self.read(rng)
+
+    def get_all_values(self):
+        self._call()
+        return [list(r) for r in self.rows]
+
+    def col_values(self, col):
+        self._call()
+        return [r[col - 1] for r in self.rows if len(r) >= col and r[col - 1]]
+
+    def update(self, rng, values, **kwargs):
+        self._call()
+        self.write(rng, values)
+
+    def batch_update(self, data, **kwargs):
+        self._call()
+        for d in data:
+            self.write(d["range"], d["values"])
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row])
+
+    def append_rows(self, rows, **kwargs):
+        self._call()
+        with self.book.lock:
+            start = len(self.rows) + 1
+            self.rows.extend(list(r) for r in rows)
+        return {"updates": {"updatedRange": "%s!A%d:C%d" % (self.title, start, len(self.rows))}}
+
+    def delete_rows(self, start, end):
+        self._call()
+        del self.rows[start - 1:end]
+
+    def clear(self):
+        self._call()
+        self.rows = []
+
+
+class FakeSpreadsheet:
+    def __init__(self, latency):
+        self.latency, self.calls = latency, 0
+        self.sheets, self.lock = {}, threading.Lock()
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def worksheet(self, name):
+        self.call()
+        if name not in self.sheets:
+            import gspread
+            raise gspread.WorksheetNotFound(name)
+        return self.sheets[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.call()
+        self.sheets[title] = FakeWorksheet(self, title)
+        return self.sheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        self.call()
+        out = []
+        for r in ranges:
+            name, rng = r.split("!")
+            out.append({"range": r, "values": self.sheets[name].read(rng)})
+        return {"valueRanges": out}
+
+    def values_batch_update(self, body):
+        self.call()
+        for d in body["data"]:
+            name, rng = d["range"].split("!")
+            self.sheets[name].write(rng, d["values"])
+
+    def batch_update(self, body):
+        self.call()
+        for req in body.get("requests", []):
+            rng = req["deleteDimension"]["range"]
+            ws = next(w for w in self.sheets.values() if w.id == rng["sheetId"])
+            del ws.rows[rng["startIndex"]:rng["endIndex"]]
+
+
+# ── 偽のLINE ────────────────────────────────────────────
+class FakeLineBotApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.pushed, self.replied = [], []
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def push_message(self, to, messages, **kwargs):
+        self._wait()
+        self.pushed.append((to, getattr(messages, "text", messages)))
+
+    def multicast(self, to, messages, **kwargs):
+        self._wait()
+        self.pushed.append((tuple(to), getattr(messages, "text", messages)))
+
+    def reply_message(self, token, messages, **kwargs):
+        self._wait()
+        self.replied.append(getattr(messages, "text", messages))
+
+    def get_message_content(self, message_id, **kwargs):
+        self._wait()
+        # 毎回違う内容にして、解析キャッシュに当たらないようにする
+        return types.SimpleNamespace(content=b"%PDF-1.4\n" + message_id.encode() + os.urandom(2048))
+
+
+# ── 署名付きイベント ─────────────────────────────────────
+def signed_body(events):
+    body = json.dumps({"destination": "Uloadtest", "events": events}, ensure_ascii=False)
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode("utf-8"), hashlib.sha256).digest()
+    return body, base64.b64encode(digest).decode()
+
+
+def message_event(message, group=GROUP_B, redelivery=False):
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex, "replyToken": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": redelivery},
+        "source": {"type": "group", "groupId": group, "userId": "Uloadtest"},
+        "message": message,
+    }
+
+
+def text_message(text, message_id=None):
+    return {"type": "text", "id": message_id or uuid.uuid4().hex[:16], "text": text}
+
+
+def file_message(message_id=None):
+    return {"type": "file", "id": message_id or uuid.uuid4().hex[:16],
+            "fileName": "週間予定.pdf", "fileSize": 2048}
+
+
+SCHEDULE_TEXT = "救急 医師A\n残り番 医師F 医師G\n(負荷試験用のテキスト)"
+
+
+def scenario_events(name, n):
+    if name == "text":
+        return [[message_event(text_message("今週の予定を確認" if i % 2 else SCHEDULE_TEXT))]
+                for i in range(n)]
+    if name == "pdf":
+        return [[message_event(file_message(), group=GROUP_A if i % 2 else GROUP_B)] for i in range(n)]
+    if name == "redelivery":
+        ids = [uuid.uuid4().hex[:16] for _ in range(max(1, n // 5))]
+        return [[message_event(file_message(ids[i % len(ids)]), redelivery=i >= len(ids))]
+                for i in range(n)]
+    raise ValueError(name)
+
+
+# ── 実行と集計 ──────────────────────────────────────────
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0
+
+
+def run_scenario(name, args, line):
+    payloads = [signed_body(evs) for evs in scenario_events(name, args.events)]
+    latencies, statuses = [], []
+    peak_threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def sample_threads():
+        while not stop.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.01)
+
+    def send(payload):
+        body, sig = payload
+        client = main.app.test_client()
+        started = time.perf_counter()
+        res = client.post("/callback", data=body.encode("utf-8"),
+                          headers={"X-Line-Signature": sig, "Content-Type": "application/json"})
+        latencies.append(time.perf_counter() - started)
+        statuses.append(res.status_code)
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    replies_before = len(line.replied)
+    jobs_before = {j["id"] for j in main.list_jobs()}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(send, payloads))
+    webhook_wall = time.perf_counter() - started
+
+    # 取り込みジョブとログの書き込みが終わるまで待つ
+    deadline = time.monotonic() + args.drain_timeout
+    while any(j["status"] in ("queued", "running") for j in main.list_jobs()):
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    main.flush_logs()
+    drain_wall = time.perf_counter() - started
+    stop.set()
+    mem_after, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    jobs = [j for j in main.list_jobs() if j["id"] not in jobs_before]
+    busy = sum("混み合って" in r for r in line.replied[replies_before:])
+    print("\n[%s] %d件・同時%d" % (name, len(payloads), args.concurrency))
+    print("  Webhook応答  p50 %.1f ms / p99 %.1f ms / 最大 %.1f ms (送信全体 %.2fs)" % (
+        _percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3,
+        max(latencies) * 1e3, webhook_wall))
+    print("  ステータス   %s" % {s: statuses.count(s) for s in sorted(set(statuses))})
+    print("  スレッド数   最大 %d" % peak_threads[0])
+    print("  メモリ       増加 %.1f MB / ピーク %.1f MB (RSS最大 %+d KB)" % (
+        (mem_after - mem_before) / 1e6, mem_peak / 1e6,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before))
+    print("  取り込み     完了 %d / 失敗 %d / 混雑で受付せず %d (処理完了まで %.2fs)" % (
+        sum(j["status"] == "done" for j in jobs), sum(j["status"] == "failed" for j in jobs),
+        busy, drain_wall))
+    print("  重複排除     %s" % main.dedupe_stats())
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--scenario", choices=["text", "pdf", "redelivery", "all"], default="all")
+    ap.add_argument("--events", type=int, default=30)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--sheets-latency", type=float, default=0.1, help="Sheets API 1回あたりの遅延(秒)")
+    ap.add_argument("--line-latency", type=float, default=0.05, help="LINE API 1回あたりの遅延(秒)")
+    ap.add_argument("--model-latency", type=float, default=0.02, help="AI応答の1チャンクごとの遅延(秒)")
+    ap.add_argument("--drain-timeout", type=float, default=120)
+    args = ap.parse_args()
+
+    sheet = FakeSpreadsheet(args.sheets_latency)
+    main._spreadsheet = lambda: sheet
+    line = FakeLineBotApi(args.line_latency)
+    main.line_bot_api = line
+    main.LOG_BATCH_DELAY = 0.05
+    parse_bench._install_replay()
+    parse_bench.ReplayClient.latency = args.model_latency
+    fixture = dict(parse_bench.load_fixtures("basic_week"))["basic_week"]
+    parse_bench._freeze_today(fixture["today"])
+    parse_bench.ReplayClient.response = fixture["response"]
+
+    names = ["text", "pdf", "redelivery"] if args.scenario == "all" else [args.scenario]
+    for name in names:
+        run_scenario(name, args, line)
+    print("\nSheets API呼び出し回数: %d / LINE送信 %d件・返信 %d件" % (
+        sheet.calls, len(line.pushed), len(line.replied)))
+    for d in main.dependency_stats():   # 偽のSheetsはHTTPセッションを通らないので、LINEとAIのみ
+        print("  %-10s %4d回 p50 %s / p95 %s 失敗 %d 再試行 %d" % (
+            d["dep"], d["count"], d["p50"], d["p95"], d["errors"], d["retries"]))
+
+
+if __name__ == "__main__":
+    main_cli()
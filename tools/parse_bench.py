@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+予定表解析パイプラインのオフライン回帰チェック+ベンチマーク。
+parse_text → _claude_parse → _corrected_dates → _clean_name → _validate_and_convert
+を、記録済みのAI応答(tools/fixtures/parse/*.json)を再生して通す。
+PDFを添えたフィクスチャは parse_pdf に通し、本番と同じく 直接読み取り → 解析キャッシュ →
+AI解析 の順に試す(解析キャッシュのシートはメモリ上の偽物)。
+ネットワークにもAnthropic APIにも接続しない。
+
+    python tools/parse_bench.py            # 回帰チェック(不一致があれば終了コード1)
+    python tools/parse_bench.py --bench    # 回帰チェック+速度・メモリの計測
+    python tools/parse_bench.py --bench --latency 0.02   # AI応答の1チャンクごとの遅延(秒)
+
+フィクスチャの形式:
+    {"today": "YYYY-MM-DD", "note": "...", "response": {"days": [...]},
+     "expect": {date: assignment} または "expect_error": "エラーメッセージの一部"}
+    PDFのとき: "pdf": "同じフォルダのPDFのファイル名", "engine": "local" など使われるべき経路
+    ("response" は省略可。AI解析まで進んだときに再生する応答)
+プロンプト・スキーマ・後処理を変えたら、このスクリプトで差分を確認する。
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main  # noqa: E402
+
+
+# ── 記録済み応答を再生するAnthropicクライアント ──────────────
+class _ReplayStream:
+    """messages.stream() の代わり。記録済みのJSONを小分けにして流す"""
+
+    def __init__(self, text, chunk, latency):
+        self.text, self.chunk, self.latency = text, chunk, latency
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        yield types.SimpleNamespace(type="thinking", thinking="")
+        for i in range(0, len(self.text), self.chunk):
+            if self.latency:
+                time.sleep(self.latency)
+            if self.closed:
+                raise ConnectionError("stream closed")
+            yield types.SimpleNamespace(type="text", text=self.text[i:i + self.chunk])
+
+    def get_final_message(self):
+        usage = types.SimpleNamespace(
+            input_tokens=0, output_tokens=len(self.text) // 2,
+            cache_read_input_tokens=0, cache_creation_input_tokens=0,
+            output_tokens_details=types.SimpleNamespace(thinking_tokens=0))
+        return types.SimpleNamespace(
+            stop_reason="end_turn", usage=usage,
+            content=[types.SimpleNamespace(type="text", text=self.text)])
+
+
+class ReplayClient:
+    """anthropic.Anthropic の代わり。次に返す応答を ReplayClient.response に入れておく"""
+    response = None
+    chunk = 64
+    latency = 0.0
+
+    def __init__(self, **kwargs):
+        self.messages = self
+
+    def stream(self, **kwargs):
+        text = json.dumps(ReplayClient.response, ensure_ascii=False)
+        return _ReplayStream(text, ReplayClient.chunk, ReplayClient.latency)
+
+
+def _install_replay():
+    try:
+        import anthropic
+    except ImportError:   # SDKが入っていない環境でも動かせるようにする
+        anthropic = types.ModuleType("anthropic")
+        sys.modules["anthropic"] = anthropic
+    anthropic.Anthropic = ReplayClient
+
+
+def _freeze_today(iso):
+    now = main.JST.localize(datetime.datetime.fromisoformat(iso + "T09:00"))
+    main.now_jst = lambda: now
+
+
+def _fixture_pdf(fx):
+    with open(os.path.join(HERE, "fixtures", "parse", fx["pdf"]), "rb") as f:
+        return f.read()
+
+
+def load_fixtures(pattern=None):
+    paths = sorted(glob.glob(os.path.join(HERE, "fixtures", "parse", "*.json")))
+    fixtures = []
+    for p in paths:
+        name = os.path.splitext(os.path.basename(p))[0]
+        if pattern and pattern not in name:
+            continue
+        with open(p, encoding="utf-8") as f:
+            fixtures.append((name, json.load(f)))
+    return fixtures
+
+
+# ── 回帰チェック ────────────────────────────────────────
+def run_fixture(fx):
+    """フィクスチャ1件をパイプラインに通す。(合否, 説明) を返す"""
+    _freeze_today(fx["today"])
+    ReplayClient.response = fx.get("response")
+    job = {"timings": {}}
+    try:
+        if "pdf" in fx:
+            got = main.parse_pdf(_fixture_pdf(fx), job)
+        else:
+            got = main.parse_text("(記録済み応答を再生)")
+    except ValueError as e:
+        want = fx.get("expect_error")
+        if want and want in str(e):
+            return True, "期待どおりのエラー: %s" % e
+        return False, "想定外のエラー: %s" % e
+    if "expect_error" in fx:
+        return False, "エラーになるはずが成功した"
+    if got != fx["expect"]:
+        diff = sorted(d for d in set(got) | set(fx["expect"]) if got.get(d) != fx["expect"].get(d))
+        return False, "結果が違う日付: %s" % ", ".join(diff)
+    if fx.get("engine") and job.get("engine") != fx["engine"]:
+        return False, "経路が違う: %s(期待 %s)" % (job.get("engine"), fx["engine"])
+    return True, "%d日分一致" % len(got) + (" (%s)" % job["engine"] if "pdf" in fx else "")
+
+
+def check(fixtures):
+    failed = 0
+    for name, fx in fixtures:
+        ok, detail = run_fixture(fx)
+        failed += not ok
+        print("%s %-28s %s" % ("OK  " if ok else "FAIL", name, detail))
+    print("\n%d件中 %d件失敗" % (len(fixtures), failed))
+    return failed == 0
+
+
+# ── ベンチマーク ────────────────────────────────────────
+def _timeit(fn, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - started) / n
+
+
+def bench(fixtures, iterations):
+    ok = [(name, fx) for name, fx in fixtures if "expect" in fx and "pdf" not in fx]
+    if not ok:
+        return
+    name, fx = ok[0]
+    _freeze_today(fx["today"])
+    ReplayClient.response = fx["response"]
+    days = fx["response"]["days"]
+
+    per_call = _timeit(lambda: main._validate_and_convert(days), iterations)
+    print("\n検証(_validate_and_convert, %s): %.1f µs/回 = %d 回/秒"
+          % (name, per_call * 1e6, 1 / per_call))
+
+    per_call = _timeit(lambda: main.parse_text("x"), max(1, iterations // 10))
+    print("解析全体(parse_text, 再生の遅延 %.3fs/チャンク): %.2f ms/件"
+          % (ReplayClient.latency, per_call * 1e3))
+
+    # 文字情報付きのPDF(ふだんの経路)。直接読み取りだけで終わる
+    for pdf_name, pdf_fx in fixtures:
+        if "pdf" not in pdf_fx:
+            continue
+        _freeze_today(pdf_fx["today"])
+        pdf = _fixture_pdf(pdf_fx)
+        per_call = _timeit(lambda: main.parse_pdf(pdf), max(1, iterations // 100))
+        print("PDFの直接読み取り(parse_pdf, %s, %d KB): %.1f ms/件"
+              % (pdf_name, len(pdf) // 1024, per_call * 1e3))
+
+    # PDFの大きさごとの所要時間とメモリ(base64化と送信データの組み立てが大きさに比例する)。
+    # 文字情報のない乱数なので、直接読み取り → キャッシュ(初回は外れ) → AI解析 の順に通る
+    _freeze_today(fx["today"])
+    ReplayClient.response = fx["response"]
+    print("\nPDFサイズ  所要時間  メモリ増加のピーク")
+    for size_kb in (100, 1000, 5000):
+        pdf = b"%PDF-1.4\n" + os.urandom(size_kb * 1024)
+        tracemalloc.start()
+        started = time.perf_counter()
+        main.parse_pdf(pdf)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%6d KB  %7.1f ms  %7.1f MB" % (size_kb, elapsed * 1e3, peak / 1e6))
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("-k", dest="pattern", help="名前にこの文字列を含むフィクスチャだけ実行")
+    ap.add_argument("--bench", action="store_true", help="速度・メモリも計測する")
+    ap.add_argument("--iterations", type=int, default=2000)
+    ap.add_argument("--latency", type=float, default=0.0, help="再生する応答の1チャンクごとの遅延(秒)")
+    args = ap.parse_args()
+
+    _install_replay()
+    ReplayClient.latency = args.latency
+    from loadtest import FakeSpreadsheet
+    sheet = FakeSpreadsheet(0)
+    main._spreadsheet = lambda: sheet
+    fixtures = load_fixtures(args.pattern)
+    ok = check(fixtures)
+    if args.bench:
+        bench(fixtures, args.iterations)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main_cli()